@@ -0,0 +1,205 @@
+"""Route-level load benchmark.
+
+Seeds a fresh SQLite database with a reproducible dataset, drives the main
+pages through the Flask test client and prints throughput, latency
+percentiles and SQL statement counts per route as JSON, e.g.
+
+    python benchmark.py --posts 100000 --comments 1000000 --requests 500 --threads 4 > bench.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import flaskapp
+from flaskapp import create_app, db
+
+ROUTES = ['Board', 'ShowPost', 'UserPage', 'ArtistList', 'NewPost']
+
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    zips = sorted(flaskapp.zipcodes())
+    start = datetime(2017, 1, 1)
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.execute(flaskapp.Genre.__table__.insert(),
+                           [{'id': i, 'name': 'Breed %d' % i} for i in range(1, args.genres + 1)])
+        users = []
+        for i in range(1, args.users + 1):
+            zip_code = rng.choice(zips)
+            lat, lon = flaskapp.zipcodes()[zip_code]
+            users.append({'id': i, 'name': 'user%d@example.com' % i, 'password': 'password',
+                          'homeTown': zip_code, 'bio': 'Bio %d' % i, 'is_musician': rng.random() < 0.3,
+                          'lat': lat, 'lon': lon, 'cell': flaskapp.grid_cell(lat, lon)})
+        connection.execute(flaskapp.User.__table__.insert(), users)
+        for offset in range(0, args.posts, args.batch):
+            rows = []
+            for i in range(offset + 1, min(offset + args.batch, args.posts) + 1):
+                timestamp = start + timedelta(minutes=i)
+                votes = rng.randint(-5, 50)
+                rows.append({'id': i, 'genre_id': rng.randint(1, args.genres), 'user_id': rng.randint(1, args.users),
+                             'name': 'Post %d' % i, 'content': 'Content of post %d' % i, 'votes': votes,
+                             'timestamp': timestamp, 'hot': flaskapp.hot_score(votes, timestamp)})
+            connection.execute(flaskapp.Post.__table__.insert(), rows)
+        for offset in range(0, args.comments, args.batch):
+            rows = []
+            for i in range(offset + 1, min(offset + args.batch, args.comments) + 1):
+                user_id = rng.randint(1, args.users)
+                rows.append({'id': i, 'posts_id': rng.randint(1, args.posts), 'user_id': user_id,
+                             'content': 'Comment %d' % i, 'whoPosted': 'user%d@example.com' % user_id})
+            connection.execute(flaskapp.Comment.__table__.insert(), rows)
+    flaskapp.repair_counters()
+    db.engine.execute('ANALYZE')
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['user'] = 'user%d@example.com' % user_id
+        session['user_id'] = user_id
+        session['logged_in'] = True
+
+
+def request_for(route, client, rng, args):
+    # Buffered, so streamed pages finish rendering (and querying) inside the timing.
+    if route == 'Board':
+        return client.get('/Breed/%d' % rng.randint(1, args.genres), buffered=True)
+    if route == 'ShowPost':
+        return client.get('/Show Post/%d' % rng.randint(1, args.posts), buffered=True)
+    if route == 'UserPage':
+        return client.get('/User Page', buffered=True)
+    if route == 'ArtistList':
+        return client.get('/Breeder List', buffered=True)
+    if route == 'NewPost':
+        return client.post('/New Post', data={'genre': rng.randint(1, args.genres),
+                                              'name': 'Benchmark post', 'content': 'Benchmark content'}, buffered=True)
+    raise ValueError(route)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def run_route(app, route, args):
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    per_thread = max(1, args.requests // args.threads)
+
+    def worker(index):
+        rng = random.Random('%s-%s-%d' % (args.seed, route, index))
+        client = app.test_client()
+        login(client, rng.randint(1, args.users))
+        for _ in range(per_thread):
+            _local.queries = 0
+            started = time.perf_counter()
+            response = request_for(route, client, rng, args)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed * 1000)
+                queries.append(_local.queries)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+    # One untimed request per route warms the template and statement caches.
+    warm = app.test_client()
+    login(warm, 1)
+    request_for(route, warm, random.Random(args.seed), args)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / wall, 1),
+        'latency_ms': dict([('p%d' % p, round(percentile(latencies, p), 3)) for p in (50, 95, 99)] +
+                           [('mean', round(sum(latencies) / len(latencies), 3))]),
+        'queries_per_request': {'mean': round(sum(queries) / float(len(queries)), 2), 'max': max(queries)},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=flaskapp.basedir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--genres', type=int, default=100)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=10000, help='rows per insert batch while seeding')
+    parser.add_argument('--database', help='SQLite file to seed (default: a fresh temporary file)')
+    parser.add_argument('--template-folder', help='override the app template folder')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    path = args.database or os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.sqlite')
+    if os.path.exists(path):
+        parser.error('%s already exists; the benchmark needs a fresh database' % path)
+    config = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'WTF_CSRF_ENABLED': False}
+    if args.template_folder:
+        config['TEMPLATE_FOLDERS'] = [args.template_folder]
+    # The breeds tenant finds the templates at the repo root.
+    app = create_app(config, tenant='breeds')
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args)
+        seed_seconds = time.perf_counter() - started
+
+    report = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'dataset': {'genres': args.genres, 'users': args.users, 'posts': args.posts,
+                    'comments': args.comments, 'seed': args.seed},
+        'requests_per_route': args.requests,
+        'threads': args.threads,
+        'seed_seconds': round(seed_seconds, 2),
+        'routes': {},
+    }
+    for route in args.routes.split(','):
+        report['routes'][route] = run_route(app, route, args)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
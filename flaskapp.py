@@ -1,30 +1,394 @@
+import atexit
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import mimetypes
 import os
-from flask import Flask, render_template, session, redirect, url_for, flash
+import random
+import secrets
+import posixpath
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial, wraps
+from flask import Flask, Blueprint, abort, render_template, session, redirect, url_for, flash, request, g, jsonify, \
+    Markup, current_app, get_flashed_messages, has_app_context, has_request_context, make_response, send_from_directory, Response, \
+    stream_with_context
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
 from flask_script import Manager
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_wtf import Form
-from wtforms import StringField, SubmitField, SelectField, PasswordField, IntegerField
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms import StringField, SubmitField, SelectField, PasswordField, IntegerField, ValidationError
 from wtforms.validators import Required, DataRequired
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from itsdangerous import BadSignature, URLSafeSerializer
+from jinja2 import Template, TemplateSyntaxError, FileSystemBytecodeCache, FileSystemLoader
+from sqlalchemy import create_engine, func, inspect, orm, select, text, tuple_, DDL
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.datastructures import CallbackDict
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.serving import run_simple
 
 basedir = os.path.abspath(os.path.dirname(__file__))
+musicdir = os.path.join(basedir, 'untitled2', 'MyMusicForum')
+# The only static tree in the repo; it carries both sites' logos.
+staticdir = os.path.join(musicdir, 'static')
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'hard to guess string'
-app.config['SQLALCHEMY_DATABASE_URI'] =\
-    'sqlite:///' + os.path.join(basedir, 'data.sqlite')
-app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+# Sites one process can serve side by side (see create_tenants_app). Each
+# gets its own app built from the shared models and views below, with its
+# own templates, static files, database and connection pools.
+TENANTS = {
+    'breeds': {
+        'prefix': '/breeds',
+        'static_folder': staticdir,
+        'config': {'TEMPLATE_FOLDERS': [basedir]},
+    },
+    'music': {
+        'prefix': '/music',
+        'static_folder': staticdir,
+        'config': {
+            'SITE_NAME': 'MyMusicForum',
+            'SITE_LOGO': 'img1/PlaceholderNameLogoSquare.png',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(musicdir, 'data.sqlite'),
+            'ARCHIVE_DATABASE': os.path.join(musicdir, 'archive.sqlite'),
+            'TEMPLATE_FOLDERS': [basedir],
+            'FRAGMENT_CACHE_DIR': os.path.join(basedir, 'fragment-cache', 'music'),
+            'SESSION_COOKIE_NAME': 'music_session',
+        },
+    },
+}
+DEFAULT_TENANT = 'breeds'
 
-manager = Manager(app)
-bootstrap = Bootstrap(app)
-moment = Moment(app)
-db = SQLAlchemy(app)
+
+def create_app(config=None, tenant=None):
+    tenant = tenant or DEFAULT_TENANT
+    if tenant not in TENANTS:
+        raise ValueError('Unknown tenant %r' % tenant)
+    settings = TENANTS[tenant]
+    app = Flask(__name__, static_folder=settings.get('static_folder', 'static'))
+    app.config['SECRET_KEY'] = 'hard to guess string'
+    app.config['SQLALCHEMY_DATABASE_URI'] =\
+        'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+    app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 25))
+    app.config['MAX_PAGE_SIZE'] = 100
+    app.config['USER_CACHE_SIZE'] = 1024
+    app.config['USER_CACHE_TTL'] = 300
+    app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'memory')
+    app.config['FRAGMENT_CACHE_SIZE'] = 512
+    app.config['FRAGMENT_CACHE_DIR'] = os.path.join(basedir, 'fragment-cache')
+    app.config['VOTE_FLUSH_INTERVAL'] = 2.0
+    app.config['VOTE_DEDUPE_SIZE'] = 100000
+    app.config['SEARCH_PAGE_SIZE'] = 20
+    app.config['ZIPCODE_FILE'] = os.path.join(basedir, 'zipcodes.csv.gz')
+    app.config['NEARBY_RADIUS_MILES'] = 50
+    app.config['NEARBY_LIMIT'] = 20
+    app.config['SQLITE_WAL'] = True
+    app.config['SQLITE_BUSY_TIMEOUT'] = 5000
+    app.config['SQLITE_PRAGMAS'] = {'synchronous': 'NORMAL', 'cache_size': -20000,
+                                    'mmap_size': 268435456, 'temp_store': 'MEMORY'}
+    app.config['SQLITE_POOL_SIZE'] = 5
+    app.config['SQLITE_MAX_OVERFLOW'] = 10
+    app.config['SQLITE_READ_ONLY_POOL'] = True
+    app.config['ASSET_BUNDLES'] = {
+        'site.css': ['bootstrap.min.css', 'css/rowc.css', 'font-awesome/css/font-awesome.min.css',
+                     'css/bootstrap-social.css', 'css/custerd.css'],
+        'site.js': ['js/jquery.js', 'js/bootstrap.min.js'],
+    }
+    app.config['ASSET_DIR'] = 'dist'
+    app.config['ASSET_MAX_AGE'] = 31536000
+    app.config['SLOW_REQUEST_THRESHOLD'] = None
+    app.config['SLOW_REQUEST_SAMPLE_RATE'] = 1.0
+    app.config['SLOW_REQUEST_MAX_STATEMENTS'] = 50
+    app.config['IMPORT_BATCH_SIZE'] = 5000
+    app.config['IMPORT_TRANSACTION_ROWS'] = 200000
+    app.config['LIVE_COMMENT_QUEUE_SIZE'] = 256
+    app.config['LIVE_COMMENT_POLL_INTERVAL'] = 15
+    app.config['API_MAX_LIMIT'] = 1000
+    app.config['STREAM_TEMPLATES'] = True
+    app.config['STREAM_CHUNK_SIZE'] = 4096
+    app.config['STREAM_GZIP_LEVEL'] = 6
+    app.config['QUERY_CHECKS'] = None
+    app.config['QUERY_BUDGET_STRICT'] = None
+    app.config['N_PLUS_ONE_THRESHOLD'] = 3
+    app.config['ARCHIVE_DATABASE'] = os.path.join(basedir, 'archive.sqlite')
+    app.config['ARCHIVE_AFTER_DAYS'] = 365
+    app.config['ARCHIVE_BATCH_SIZE'] = 5000
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:150000'
+    app.config['PASSWORD_HASH_WORKERS'] = 2
+    app.config['PASSWORD_HASH_QUEUE'] = 16
+    app.config['THROTTLE_IP_RATE'] = 0.5
+    app.config['THROTTLE_IP_BURST'] = 20
+    app.config['THROTTLE_ACCOUNT_RATE'] = 1 / 30.0
+    app.config['THROTTLE_ACCOUNT_BURST'] = 5
+    app.config['THROTTLE_SIZE'] = 100000
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    app.config['SESSION_BACKEND'] = 'sqlite'
+    app.config['SESSION_IDLE_TIMEOUT'] = 14 * 24 * 3600
+    app.config['SESSION_REFRESH_INTERVAL'] = 3600
+    app.config['SESSION_CACHE_SIZE'] = 10000
+    app.config['SESSION_CACHE_TTL'] = 60
+    app.config['SESSION_SWEEP_INTERVAL'] = 600
+
+    app.config['JINJA_CACHE_DIR'] = os.path.join(basedir, 'jinja-cache')
+    app.config['SITE_NAME'] = 'Rare Breeds'
+    app.config['SITE_LOGO'] = 'img1/bdr_one_color_logo_mark_small.png'
+    app.config['TEMPLATE_FOLDERS'] = None
+    app.config.update(settings.get('config', {}))
+    app.config.update(config or {})
+
+    app.extensions['flaskapp'] = {}
+    bootstrap.init_app(app)
+    moment.init_app(app)
+    db.init_app(app)
+    app.register_blueprint(views)
+    if app.config['SESSION_BACKEND'] == 'sqlite':
+        app.session_interface = StoredSessionInterface()
+    if app.config['TRUSTED_PROXIES']:
+        # Behind that many reverse proxies, remote_addr comes from
+        # X-Forwarded-For; otherwise every client shares the proxy's
+        # address, and its throttle bucket.
+        n = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=n, x_proto=n)
+    if app.config['TEMPLATE_FOLDERS']:
+        # Searched in order, so a tenant can override single templates and
+        # take the rest from the shared set.
+        app.jinja_loader = FileSystemLoader(app.config['TEMPLATE_FOLDERS'])
+    if app.config['JINJA_CACHE_DIR']:
+        # Compiled templates persist across restarts, so a fresh worker
+        # loads bytecode instead of parsing every template again.
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+    app.jinja_env.template_class = TimedTemplate
+    return app
+
+
+class TenantDispatcher(object):
+    # Picks a tenant by Host header, then by leading path segment (which
+    # moves into SCRIPT_NAME so url_for keeps the prefix), else the default.
+    def __init__(self, default, hosts, prefixes):
+        self.default = default
+        self.hosts = hosts
+        self.prefixes = prefixes
+
+    def __call__(self, environ, start_response):
+        app = self.hosts.get(environ.get('HTTP_HOST', '').split(':')[0].lower())
+        if app is None:
+            path = environ.get('PATH_INFO', '')
+            for prefix, prefixed in self.prefixes:
+                if path == prefix or path.startswith(prefix + '/'):
+                    environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+                    environ['PATH_INFO'] = path[len(prefix):]
+                    app = prefixed
+                    break
+        return (app or self.default)(environ, start_response)
+
+
+def create_tenants_app(config=None):
+    """WSGI app serving every tenant from one process.
+
+    TENANT_HOSTS maps host names to tenants, e.g.
+    "breeds.example.com=breeds,forum.example.com=music".
+    """
+    apps = dict((name, create_app(config, tenant=name)) for name in TENANTS)
+    hosts = {}
+    for entry in os.environ.get('TENANT_HOSTS', '').split(','):
+        if '=' in entry:
+            host, name = entry.split('=', 1)
+            hosts[host.strip().lower()] = apps[name.strip()]
+    prefixes = [(settings['prefix'], apps[name]) for name, settings in TENANTS.items() if settings.get('prefix')]
+    return TenantDispatcher(apps[DEFAULT_TENANT], hosts, prefixes)
+
+
+manager = Manager(create_app)
+manager.add_option('-t', '--tenant', dest='tenant', choices=sorted(TENANTS),
+                   help='run the command against one tenant\'s database (default %s)' % DEFAULT_TENANT)
+
+
+def apply_sqlite_pragmas(dbapi_connection, config, read_only=False):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = %d' % config['SQLITE_BUSY_TIMEOUT'])
+    if read_only:
+        cursor.execute('PRAGMA query_only = ON')
+    elif config['SQLITE_WAL']:
+        # WAL lets readers carry on against the last commit while a writer
+        # appends, instead of queueing behind its lock.
+        cursor.execute('PRAGMA journal_mode = WAL')
+    for name, value in config['SQLITE_PRAGMAS'].items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def sqlite_file(uri):
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:'):
+        return url.database
+    return None
+
+
+_read_only_engines = {}
+_read_only_lock = threading.Lock()
+
+
+def read_only_pool(path, config):
+    with _read_only_lock:
+        engine = _read_only_engines.get(path)
+        if engine is None:
+            engine = create_engine(
+                'sqlite:///file:%s?mode=ro&uri=true' % path, poolclass=QueuePool,
+                pool_size=config['SQLITE_POOL_SIZE'], max_overflow=config['SQLITE_MAX_OVERFLOW'],
+                connect_args={'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000.0, 'check_same_thread': False})
+            db.event.listen(engine, 'connect',
+                            lambda connection, record: apply_sqlite_pragmas(connection, config, True))
+            _read_only_engines[path] = engine
+    return engine
+
+
+def read_only_engine():
+    config = current_app.config
+    path = sqlite_file(config['SQLALCHEMY_DATABASE_URI'])
+    if path is None or not config['SQLITE_READ_ONLY_POOL']:
+        return None
+    return read_only_pool(path, config)
+
+
+# Posts older than ARCHIVE_AFTER_DAYS move, with their comments, into a
+# separate SQLite file with the same tables (see archive_posts), so the hot
+# tables and their indexes stay small. The app only ever reads it.
+def archive_session():
+    if 'archive_session' not in g:
+        path = current_app.config['ARCHIVE_DATABASE']
+        if not path or not os.path.exists(path):
+            g.archive_session = None
+        else:
+            g.archive_session = orm.Session(bind=read_only_pool(path, current_app.config))
+    return g.archive_session
+
+
+@contextmanager
+def archive_attached():
+    # A connection to the hot database with the archive file attached as
+    # "archive", or None attached when there is no archive yet.
+    path = current_app.config['ARCHIVE_DATABASE']
+    attached = bool(path) and os.path.exists(path)
+    connection = db.engine.connect()
+    try:
+        if attached:
+            connection.execute('ATTACH DATABASE ? AS archive', (path,))
+        yield connection, attached
+    finally:
+        if attached:
+            connection.execute('DETACH DATABASE archive')
+        connection.close()
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get('read_only'):
+            engine = read_only_engine()
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    # SQLAlchemy with the SQLite profile above: pooled, pragma-tuned
+    # connections and a separate read-only pool for views marked read_only.
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite') and options.get('poolclass') is not None \
+                and options['poolclass'].__name__ == 'NullPool':
+            options['poolclass'] = QueuePool
+            options['pool_size'] = current_app.config['SQLITE_POOL_SIZE']
+            options['max_overflow'] = current_app.config['SQLITE_MAX_OVERFLOW']
+            connect_args = options.setdefault('connect_args', {})
+            connect_args.setdefault('timeout', current_app.config['SQLITE_BUSY_TIMEOUT'] / 1000.0)
+            connect_args.setdefault('check_same_thread', False)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if sa_url.drivername.startswith('sqlite'):
+            # Engines are built on first use inside an app context; bind
+            # that app's settings so the pool never needs one again.
+            config = current_app.config
+            db.event.listen(engine, 'connect', lambda connection, record: apply_sqlite_pragmas(connection, config))
+        return engine
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class Views(Blueprint):
+    # Routes, hooks and template globals are declared at import time and
+    # attached to each app create_app builds. Endpoints keep their bare
+    # names (url_for('ShowPost')) rather than taking the blueprint prefix.
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        endpoint = endpoint or view_func.__name__
+        self.record(lambda state: state.app.add_url_rule(rule, endpoint, view_func, **options))
+
+
+def app_state():
+    return current_app.extensions['flaskapp']
+
+
+_app_state_lock = threading.Lock()
+
+
+def per_app(factory):
+    # Caches, buffers and counters belong to one application and are only
+    # built the first time something in that app touches them.
+    name = factory.__name__
+
+    def get():
+        state = app_state()
+        if name not in state:
+            with _app_state_lock:
+                if name not in state:
+                    state[name] = factory(current_app._get_current_object())
+        return state[name]
+    return LocalProxy(get)
+
+
+bootstrap = Bootstrap()
+moment = Moment()
+db = TunedSQLAlchemy()
+views = Views('views', __name__)
 
 class Genre(db.Model):
     __tablename__ = 'genres'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
+    post_count = db.Column(db.Integer, default=0)
+    last_post_at = db.Column(db.DateTime)
     posts = db.relationship('Post', backref='genres', lazy='dynamic')
 
     def __repr__(self):
@@ -34,10 +398,15 @@ class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
-    password = db.Column(db.String(64))
+    password = db.Column(db.String(128))
     homeTown = db.Column(db.Integer)
     bio = db.Column(db.String(64))
     is_musician = db.Column(db.Boolean)
+    lat = db.Column(db.Float)
+    lon = db.Column(db.Float)
+    cell = db.Column(db.Integer)
+    __table_args__ = (db.Index('ix_users_homeTown_is_musician', 'homeTown', 'is_musician'),
+                      db.Index('ix_users_is_musician_cell', 'is_musician', 'cell'))
     posts = db.relationship('Post', backref='users', lazy='dynamic')
     comments = db.relationship('Comment', backref='users', lazy='dynamic')
 
@@ -48,27 +417,1319 @@ class Post(db.Model):
     __tablename__ = 'posts'
     id = db.Column(db.Integer, primary_key=True)
     genre_id = db.Column(db.Integer, db.ForeignKey('genres.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     name = db.Column(db.String(64))
     content = db.Column(db.String(64))
-    votes = db.Column(db.Integer)
+    votes = db.Column(db.Integer, default=0)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    hot = db.Column(db.Float)
+    comment_count = db.Column(db.Integer, default=0)
+    # (genre_id, id) serves both genre_id lookups and ordered board pages;
+    # (genre_id, hot) does the same for the ranked ordering.
+    # AUTOINCREMENT keeps ids that moved to the archive from being handed
+    # out again.
+    __table_args__ = (db.Index('ix_posts_genre_id_id', 'genre_id', 'id'),
+                      db.Index('ix_posts_genre_id_hot', 'genre_id', 'hot'),
+                      {'sqlite_autoincrement': True})
     comments = db.relationship('Comment', backref='posts', lazy='dynamic')
 
     def __repr__(self):
         return '<Post %r>' % self.name
 
+class EntityVersion(db.Model):
+    __tablename__ = 'entity_versions'
+    key = db.Column(db.String(96), primary_key=True)
+    version = db.Column(db.Integer)
+    modified = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<EntityVersion %r %r>' % (self.key, self.version)
+
+class Vote(db.Model):
+    __tablename__ = 'votes'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    value = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<Vote %r %r>' % (self.post_id, self.value)
+
+class StoredSession(db.Model):
+    __tablename__ = 'sessions'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.Text)
+    expires = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<StoredSession %r>' % self.id
+
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(64))
     whoPosted = db.Column(db.String(64))
-    posts_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    posts_id = db.Column(db.Integer, db.ForeignKey('posts.id'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     def __repr__(self):
         return '<Comment %r>' % self.name
 
 
+# Posts and comments share one FTS5 index. Rowids interleave the two
+# (posts even, comments odd) so triggers can update a row by rowid, and the
+# breed is stored as a 'g<id>' token so breed filters are index lookups.
+SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+        title, body, genre, kind UNINDEXED, post_id UNINDEXED,
+        tokenize = 'porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS posts_search_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO search (rowid, title, body, genre, kind, post_id)
+        VALUES (new.id * 2, new.name, new.content, 'g' || new.genre_id, 'post', new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_search_update AFTER UPDATE OF name, content, genre_id ON posts BEGIN
+        DELETE FROM search WHERE rowid = old.id * 2;
+        INSERT INTO search (rowid, title, body, genre, kind, post_id)
+        VALUES (new.id * 2, new.name, new.content, 'g' || new.genre_id, 'post', new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_search_delete AFTER DELETE ON posts BEGIN
+        DELETE FROM search WHERE rowid = old.id * 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_search_insert AFTER INSERT ON comments BEGIN
+        INSERT INTO search (rowid, title, body, genre, kind, post_id)
+        VALUES (new.id * 2 + 1, '', new.content,
+                'g' || (SELECT genre_id FROM posts WHERE id = new.posts_id), 'comment', new.posts_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_search_update AFTER UPDATE OF content, posts_id ON comments BEGIN
+        DELETE FROM search WHERE rowid = old.id * 2 + 1;
+        INSERT INTO search (rowid, title, body, genre, kind, post_id)
+        VALUES (new.id * 2 + 1, '', new.content,
+                'g' || (SELECT genre_id FROM posts WHERE id = new.posts_id), 'comment', new.posts_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_search_delete AFTER DELETE ON comments BEGIN
+        DELETE FROM search WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+for statement in SEARCH_DDL:
+    db.event.listen(db.metadata, 'after_create', DDL(statement))
+
+
+# Breeder locations are bucketed into a fixed lat/lon grid; a radius query
+# reads only the cells its bounding box touches, straight off the
+# (is_musician, cell) index. Changing GRID_DEGREES means re-running
+# upgrade_db to recompute users.cell.
+GRID_DEGREES = 0.5
+GRID_COLUMNS = int(360 / GRID_DEGREES)
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = 69.09
+
+_zipcodes = None
+
+
+def zipcodes():
+    global _zipcodes
+    if _zipcodes is None:
+        table = {}
+        with gzip.open(current_app.config['ZIPCODE_FILE'], 'rt') as f:
+            for line in f:
+                if line.startswith('#') or line.startswith('zip'):
+                    continue
+                zip_code, lat, lon = line.rstrip().split(',')
+                table[int(zip_code)] = (float(lat), float(lon))
+        _zipcodes = table
+    return _zipcodes
+
+
+def grid_cell(lat, lon):
+    row = int((lat + 90) // GRID_DEGREES)
+    column = int((lon + 180) // GRID_DEGREES) % GRID_COLUMNS
+    return row * GRID_COLUMNS + column
+
+
+def cells_within(lat, lon, miles):
+    dlat = miles / MILES_PER_DEGREE
+    dlon = miles / (MILES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    first_row = int((max(lat - dlat, -90) + 90) // GRID_DEGREES)
+    last_row = int((min(lat + dlat, 90) + 90) // GRID_DEGREES)
+    if dlon >= 180:
+        columns = range(GRID_COLUMNS)
+    else:
+        first_column = int((lon - dlon + 180) // GRID_DEGREES)
+        last_column = int((lon + dlon + 180) // GRID_DEGREES)
+        columns = set(c % GRID_COLUMNS for c in range(first_column, last_column + 1))
+    return [row * GRID_COLUMNS + column for row in range(first_row, last_row + 1) for column in columns]
+
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+@db.event.listens_for(User, 'before_insert')
+@db.event.listens_for(User, 'before_update')
+def locate_user(mapper, connection, target):
+    location = zipcodes().get(target.homeTown) if target.homeTown is not None else None
+    if location is None:
+        target.lat = target.lon = target.cell = None
+    else:
+        target.lat, target.lon = location
+        target.cell = grid_cell(*location)
+
+
+def nearby_breeders(zip_code, miles, limit):
+    location = zipcodes().get(zip_code)
+    if location is None:
+        return []
+    lat, lon = location
+    candidates = User.query.filter(User.is_musician == True, User.cell.in_(cells_within(lat, lon, miles)))
+    nearby = []
+    for breeder in candidates:
+        breeder.distance = distance_miles(lat, lon, breeder.lat, breeder.lon)
+        if breeder.distance <= miles:
+            nearby.append(breeder)
+    nearby.sort(key=lambda breeder: breeder.distance)
+    return nearby[:limit]
+
+
+class LRUCache(object):
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CachedUser(object):
+    # Plain snapshot of a users row; safe to keep across requests, unlike
+    # an ORM instance that is detached and expired once its session ends.
+    def __init__(self, user):
+        for column in User.__table__.columns:
+            if column.key != 'password':
+                setattr(self, column.key, getattr(user, column.key))
+
+    def __repr__(self):
+        return '<User %r>' % self.name
+
+
+@per_app
+def user_cache(app):
+    return LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(target.id)
+    bump_versions(['user:%s' % target.name], connection)
+
+
+BUMP_VERSION_SQL = text(
+    'INSERT INTO entity_versions (key, version, modified) VALUES (:key, 1, :now) '
+    'ON CONFLICT (key) DO UPDATE SET version = version + 1, modified = :now')
+
+
+def bump_versions(keys, connection=None):
+    # Runs inside the caller's transaction, so a version only moves when
+    # the write it describes commits.
+    now = datetime.utcnow().replace(microsecond=0)
+    params = [{'key': key, 'now': now} for key in keys]
+    if params:
+        (connection or db.session).execute(BUMP_VERSION_SQL, params)
+
+
+def etag_salt():
+    # Changes whenever the code or templates are redeployed, so old ETags
+    # never match pages rendered by new templates.
+    state = app_state()
+    if 'etag_salt' not in state:
+        paths = [os.path.abspath(__file__)]
+        for folder in getattr(current_app.jinja_loader, 'searchpath', []):
+            if os.path.isdir(folder):
+                paths.extend(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.html'))
+        state['etag_salt'] = ','.join('%s:%d' % (path, os.path.getmtime(path)) for path in sorted(paths))
+    return state['etag_salt']
+
+
+def conditional(keys_for, form=False):
+    # Answer repeat GETs with 304 from a primary-key lookup of the entity
+    # versions the page depends on, before the view runs any other query.
+    # Pages with a form also vary on the CSRF token's time window, so a
+    # cached copy never outlives the token it embeds.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+            # 'global' is bumped by bulk operations that touch everything.
+            keys = sorted(set(keys_for(**kwargs)) | set(['global']))
+            rows = EntityVersion.query.filter(EntityVersion.key.in_(keys)).all()
+            versions = dict((row.key, row.version) for row in rows)
+            # Fragment caching reuses these instead of reading them again.
+            g.entity_versions = dict((key, versions.get(key, 0)) for key in keys)
+            modified = max([row.modified for row in rows if row.modified] or [None])
+            state = '|'.join(['%s=%s' % (key, versions.get(key, 0)) for key in keys] + [
+                etag_salt(), request.script_root + request.full_path, str(session.get('logged_in')), str(session.get('user_id'))])
+            if form and current_app.config.get('WTF_CSRF_ENABLED', True):
+                generate_csrf()
+                limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+                state += '|%s|%s' % (session.get('csrf_token'), int(time.time() // limit) if limit else '')
+            etag = hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+            if request.accept_encodings['gzip'] and etag + '-gzip' in request.if_none_match:
+                # The gzip and identity bodies are different representations.
+                etag += '-gzip'
+            not_modified = etag in request.if_none_match
+            if not request.if_none_match and modified is not None and request.if_modified_since \
+                    and current_app.session_cookie_name not in request.cookies:
+                # Last-Modified cannot see session state, so only trust it
+                # from visitors who have never had a session.
+                not_modified = modified <= request.if_modified_since.replace(tzinfo=None)
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.headers.get('Content-Encoding') == 'gzip' and not etag.endswith('-gzip'):
+                    etag += '-gzip'
+            if etag.endswith('-gzip'):
+                response.vary.add('Accept-Encoding')
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+def load_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        row = User.query.get(user_id)
+        if row is None:
+            return None
+        user = CachedUser(row)
+        user_cache.set(user_id, user)
+    return user
+
+
+def current_user():
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        if user_id is None and 'user' in session:
+            # Sessions issued before user ids were stored only carry the name.
+            row = User.query.filter_by(name=session['user']).first()
+            user_id = session['user_id'] = row.id if row else None
+        g.current_user = load_user(user_id) if user_id is not None else None
+    return g.current_user
+
+
+def login_user(user):
+    if hasattr(session, 'regenerate'):
+        # A fresh id at sign-in, so an id planted beforehand is worthless.
+        session.regenerate()
+    session['user'] = user.name
+    session['user_id'] = user.id
+    session['logged_in'] = True
+
+
+class PasswordHasher(object):
+    # The KDF is deliberately slow, so it runs on a few worker threads
+    # (hashlib drops the GIL while it grinds) and callers are turned away
+    # once max_pending hashes are waiting, rather than letting a login
+    # storm tie up every request thread.
+    def __init__(self, method, workers, max_pending):
+        self.method = method
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(False):
+            raise ServiceUnavailable('Too many sign-ins in progress, please try again.', retry_after=1)
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, 16)
+
+    def verify(self, stored, password):
+        if not stored:
+            return False
+        if not PASSWORD_HASH_PATTERN.match(stored):
+            # Rows from before hashing hold the password itself.
+            return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+        return self._run(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        return not stored or not stored.startswith(self.method + '$')
+
+
+PASSWORD_HASH_PATTERN = re.compile(r'pbkdf2:[\w-]+(:\d+)?\$')
+
+
+@per_app
+def password_hasher(app):
+    return PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                          app.config['PASSWORD_HASH_QUEUE'])
+
+
+def check_password(user, password):
+    if not password_hasher.verify(user.password, password):
+        return False
+    if password_hasher.needs_rehash(user.password):
+        # Upgrades plain rows and ones hashed at an older cost.
+        try:
+            user.password = password_hasher.hash(password)
+        except ServiceUnavailable:
+            pass
+    return True
+
+
+class TokenBuckets(object):
+    # One bucket per key, refilled at rate tokens a second up to burst.
+    # Keys that fall out of the LRU come back with a full bucket.
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        # Returns 0 if a token was taken, else the seconds until one is due.
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets.set(key, (tokens, now))
+                return (1 - tokens) / self.rate
+            self._buckets.set(key, (tokens - 1, now))
+            return 0
+
+
+@per_app
+def ip_throttle(app):
+    return TokenBuckets(app.config['THROTTLE_IP_RATE'], app.config['THROTTLE_IP_BURST'], app.config['THROTTLE_SIZE'])
+
+
+@per_app
+def account_throttle(app):
+    return TokenBuckets(app.config['THROTTLE_ACCOUNT_RATE'], app.config['THROTTLE_ACCOUNT_BURST'],
+                        app.config['THROTTLE_SIZE'])
+
+
+def throttle_credentials(account):
+    # Sheds credential stuffing before it costs a database lookup or a hash.
+    # remote_addr is the client's only with TRUSTED_PROXIES set to match
+    # the deployment.
+    wait = max(ip_throttle.take(request.remote_addr or ''), account_throttle.take((account or '').lower()))
+    if wait:
+        raise TooManyRequests('Too many attempts, please wait and try again.', retry_after=int(math.ceil(wait)))
+
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.previous_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        if self.sid is not None:
+            self.previous_sid, self.sid = self.sid, None
+        self.modified = True
+
+
+class SessionStore(object):
+    # Sessions live in the sessions table, fronted by an in-process LRU of
+    # their serialized form, so an active visitor costs a dict lookup. The
+    # LRU entries expire after SESSION_CACHE_TTL, which bounds how long
+    # another process can keep serving a session this one deleted.
+    def __init__(self, app):
+        self.app = app
+        self.serializer = session_json_serializer
+        self._cache = LRUCache(app.config['SESSION_CACHE_SIZE'], app.config['SESSION_CACHE_TTL'])
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        entry = self._cache.get(sid)
+        if entry is None:
+            table = StoredSession.__table__
+            row = db.session.execute(select([table.c.data, table.c.expires]).where(table.c.id == sid),
+                                     bind=db.engine).first()
+            if row is None:
+                return None
+            entry = (row.data, row.expires)
+            self._cache.set(sid, entry)
+        data, expires = entry
+        if expires <= datetime.utcnow():
+            return None
+        return ServerSession(self.serializer.loads(data), sid, expires)
+
+    def save(self, session, expires):
+        # Writes ride on the request's own transaction; a second connection
+        # would wait on the lock the request may already hold.
+        data = self.serializer.dumps(dict(session))
+        db.session.execute(StoredSession.__table__.insert().prefix_with('OR REPLACE').values(
+            id=session.sid, user_id=session.get('user_id'), data=data, expires=expires), bind=db.engine)
+        self._cache.set(session.sid, (data, expires))
+        self._start()
+
+    def touch(self, session, expires):
+        table = StoredSession.__table__
+        db.session.execute(table.update().where(table.c.id == session.sid).values(expires=expires), bind=db.engine)
+        self._cache.set(session.sid, (self.serializer.dumps(dict(session)), expires))
+
+    def delete(self, sid):
+        table = StoredSession.__table__
+        db.session.execute(table.delete().where(table.c.id == sid), bind=db.engine)
+        self._cache.pop(sid)
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='session-sweeper')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.app.config['SESSION_SWEEP_INTERVAL'])
+            try:
+                self.sweep()
+            except Exception:
+                self.app.logger.exception('Session sweep failed')
+
+    def sweep(self):
+        with self.app.app_context():
+            table = StoredSession.__table__
+            with db.engine.begin() as connection:
+                return connection.execute(table.delete().where(table.c.expires < datetime.utcnow())).rowcount
+
+
+@per_app
+def session_store(app):
+    return SessionStore(app)
+
+
+class StoredSessionInterface(SessionInterface):
+    # The cookie carries only a random id (unsigned; 128 bits cannot be
+    # guessed). Expiry slides with activity, but the row is only rewritten
+    # once SESSION_REFRESH_INTERVAL has passed since it was last touched.
+    # The id is issued on the first write beyond a CSRF token: until then
+    # the cookie is the signed token itself, so anonymous visitors and
+    # crawlers cost no row.
+    def csrf_serializer(self, app):
+        return URLSafeSerializer(app.secret_key, salt='csrf-session')
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and len(sid) <= 32:
+            stored = session_store.load(sid)
+            if stored is not None:
+                return stored
+        elif sid:
+            try:
+                token = self.csrf_serializer(app).loads(sid)
+            except BadSignature:
+                return ServerSession()
+            return ServerSession({app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'): token})
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            session_store.delete(session.previous_sid)
+            session.previous_sid = None
+        if not session:
+            if session.sid is not None:
+                session_store.delete(session.sid)
+            if session.sid is not None or app.session_cookie_name in request.cookies:
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=app.config['SESSION_IDLE_TIMEOUT'])
+        if session.sid is None and list(session) == [app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')]:
+            if session.modified:
+                self.set_cookie(app, session, response, self.csrf_serializer(app).dumps(list(session.values())[0]))
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(16)
+            session_store.save(session, expires)
+            self.set_cookie(app, session, response, session.sid)
+        elif session.modified:
+            session_store.save(session, expires)
+        elif expires - session.expires >= timedelta(seconds=app.config['SESSION_REFRESH_INTERVAL']):
+            session_store.touch(session, expires)
+        else:
+            return
+        if response.is_streamed:
+            # Teardown only commits once the body has been sent; don't hold
+            # the write lock that long.
+            db.session.commit()
+
+    def set_cookie(self, app, session, response, value):
+        response.set_cookie(app.session_cookie_name, value, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+class MemoryFragmentStore(object):
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+        self._generations = {}
+
+    def token(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def get(self, namespace, key, token):
+        # Bumping a namespace's generation orphans its old entries, which
+        # then age out of the LRU instead of being hunted down one by one.
+        return self._cache.get((namespace, token, key))
+
+    def set(self, namespace, key, value, token):
+        if token == self.token(namespace):
+            self._cache.set((namespace, token, key), value)
+
+    def delete_namespace(self, namespace):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+
+class DiskFragmentStore(object):
+    # One directory per namespace generation so every worker process
+    # sharing the path sees the same entries and the same invalidations.
+    # The current generation is a random token in a file beside it.
+    def __init__(self, path):
+        self.path = path
+
+    def _stem(self, namespace):
+        return os.path.join(self.path, hashlib.sha1(namespace.encode('utf-8')).hexdigest())
+
+    def _file(self, namespace, key, token):
+        return os.path.join('%s.%s' % (self._stem(namespace), token), hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def token(self, namespace):
+        try:
+            with open(self._stem(namespace) + '.token') as f:
+                return f.read()
+        except (IOError, OSError):
+            return '0'
+
+    def get(self, namespace, key, token):
+        try:
+            with open(self._file(namespace, key, token), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def set(self, namespace, key, value, token):
+        if token != self.token(namespace):
+            return
+        path = self._file(namespace, key, token)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value.encode('utf-8'))
+        os.replace(tmp, path)
+
+    def delete_namespace(self, namespace):
+        stem = self._stem(namespace)
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        token = secrets.token_hex(8)
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+        os.replace(tmp, stem + '.token')
+        # A reader that passed its token check just before the swap may
+        # still recreate an old directory, so sweep every stale one.
+        for directory in glob.glob(stem + '.*'):
+            if os.path.isdir(directory) and not directory.endswith('.' + token):
+                doomed = '%s.%d.%d' % (directory, os.getpid(), threading.get_ident())
+                try:
+                    os.rename(directory, doomed)
+                except OSError:
+                    continue
+                shutil.rmtree(doomed, ignore_errors=True)
+
+
+class FragmentCache(object):
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def render(self, namespace, key, render, versions=()):
+        # Fragments hold absolute URLs, so a tenant reachable both by host
+        # and under a path prefix keeps one copy per mount point. They are
+        # also keyed on the entity versions they depend on: invalidate only
+        # reaches this worker's memory store, but a write in any worker
+        # bumps a version, and the old entries then age out of the LRU.
+        key = '%s|%s|%s' % (request.script_root, key, entity_versions(versions))
+        # Taken before rendering: if the namespace is invalidated while the
+        # rows are read, the stale result is not stored under the new token.
+        token = self.store.token(namespace)
+        value = self.store.get(namespace, key, token)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            value = render()
+            self.store.set(namespace, key, value, token)
+        return Markup(value)
+
+    def invalidate(self, namespace):
+        self.store.delete_namespace(namespace)
+
+    def stats(self):
+        return {'backend': type(self.store).__name__, 'hits': self.hits, 'misses': self.misses}
+
+
+def entity_versions(keys):
+    keys = sorted(set(keys) | set(['global'])) if keys else []
+    loaded = g.setdefault('entity_versions', {})
+    missing = [key for key in keys if key not in loaded]
+    if missing:
+        rows = EntityVersion.query.filter(EntityVersion.key.in_(missing)).all()
+        versions = dict((row.key, row.version) for row in rows)
+        loaded.update((key, versions.get(key, 0)) for key in missing)
+    return ','.join('%s=%s' % (key, loaded[key]) for key in keys)
+
+
+def make_fragment_store(config):
+    if config['FRAGMENT_CACHE'] == 'disk':
+        return DiskFragmentStore(config['FRAGMENT_CACHE_DIR'])
+    return MemoryFragmentStore(config['FRAGMENT_CACHE_SIZE'])
+
+
+@per_app
+def fragment_cache(app):
+    return FragmentCache(make_fragment_store(app.config))
+
+
+def invalidate_on_commit(namespace):
+    # Dropping fragments before the write commits would let a concurrent
+    # reader re-cache the old rows, so wait for the commit to land.
+    db.session.info.setdefault('fragment_invalidations', set()).add(namespace)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def apply_fragment_invalidations(session):
+    for namespace in session.info.pop('fragment_invalidations', ()):
+        fragment_cache.invalidate(namespace)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_fragment_invalidations(session):
+    session.info.pop('fragment_invalidations', None)
+
+
+class CommentBroker(object):
+    """Fans committed comments out to the live streams open on each post."""
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, post_id):
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers[post_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, post_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(post_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[post_id]
+
+    def publish(self, post_id, comment_id, html):
+        with self._lock:
+            subscribers = list(self._subscribers.get(post_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((comment_id, html))
+            except queue.Full:
+                # A slow reader misses the push but picks the row up on its next poll.
+                pass
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+@per_app
+def comment_broker(app):
+    return CommentBroker(app.config['LIVE_COMMENT_QUEUE_SIZE'])
+
+
+def publish_on_commit(comment):
+    db.session.info.setdefault('comment_events', []).append(
+        (comment.posts_id, comment.id, render_template('Comment.html', comment=comment)))
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def publish_comment_events(session):
+    for post_id, comment_id, html in session.info.pop('comment_events', ()):
+        comment_broker.publish(post_id, comment_id, html)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_comment_events(session):
+    session.info.pop('comment_events', None)
+
+
+def sse_event(event_id, name, data):
+    lines = ''.join('data: %s\n' % line for line in data.splitlines() or [''])
+    return 'id: %d\nevent: %s\n%s\n' % (event_id, name, lines)
+
+
+def comment_events(post_id, after):
+    # SQLite commits one writer at a time, so comment ids become visible in
+    # order: everything up to the last polled id has been seen. Pushed rows
+    # may skip ids committed by another process, so the event id only ever
+    # advances on a poll and a reconnect resumes from there; the page drops
+    # rows it already has.
+    subscription = comment_broker.subscribe(post_id)
+    pushed = set()
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            batch = Comment.query.filter(Comment.posts_id == post_id, Comment.id > after) \
+                .order_by(Comment.id).limit(current_app.config['MAX_PAGE_SIZE']).all()
+            for comment in batch:
+                after = comment.id
+                if comment.id not in pushed:
+                    yield sse_event(after, 'comment', render_template('Comment.html', comment=comment))
+            # Hand the connection back while the stream idles.
+            db.session.remove()
+            pushed = set(id for id in pushed if id > after)
+            if len(batch) == current_app.config['MAX_PAGE_SIZE']:
+                continue
+            # Pushes only come from this process; the next poll picks up
+            # anything another process committed meanwhile.
+            deadline = time.time() + current_app.config['LIVE_COMMENT_POLL_INTERVAL']
+            while True:
+                try:
+                    comment_id, html = subscription.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if comment_id > after and comment_id not in pushed:
+                    pushed.add(comment_id)
+                    yield sse_event(after, 'comment', html)
+            yield ': keepalive\n\n'
+    finally:
+        comment_broker.unsubscribe(post_id, subscription)
+
+
+# Query args that shape a listing. Pager links carry only these, and cached
+# fragments are keyed on them, so a stray ?utm=... can't leak into a
+# fragment everyone else is served.
+PAGE_ARGS = ('sort', 'per_page', 'after', 'before', 'q', 'breed', 'page')
+
+
+def cursor_key():
+    return '|'.join(str(request.args.get(name)) for name in PAGE_ARGS)
+
+
+HOT_EPOCH = datetime(2016, 1, 1)
+
+
+def hot_score(votes, timestamp):
+    # Log-scaled votes plus a term that grows with post time: a post needs
+    # ten times the votes to outrank one posted 12.5 hours later. Scores
+    # never need recomputing as posts age, so the (genre_id, hot) index
+    # stays valid and only a vote changes a post's score.
+    votes = votes or 0
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S')
+    seconds = (timestamp - HOT_EPOCH).total_seconds() if timestamp else 0
+    sign = (votes > 0) - (votes < 0)
+    return round(sign * math.log10(max(abs(votes), 1)) + seconds / 45000, 7)
+
+
+@db.event.listens_for(Engine, 'connect')
+def register_sql_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('hot_score', 2, hot_score)
+
+
+class VoteBuffer(object):
+    # Votes are folded into per-post deltas in memory and written out by a
+    # background thread in a few batched statements per interval.
+    def __init__(self, app, interval, dedupe_size):
+        self.app = app
+        self.interval = interval
+        self._seen = LRUCache(dedupe_size)
+        self._deltas = defaultdict(int)
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _known(self, key):
+        # Unwritten votes win over the table even once _seen has evicted them.
+        value = self._seen.get(key)
+        if value is None:
+            value = self._pending.get(key, self._flushing.get(key))
+        return value
+
+    def record(self, user_id, post_id, value):
+        key = (user_id, post_id)
+        with self._lock:
+            previous = self._known(key)
+        if previous is None:
+            vote = Vote.query.get(key)
+            previous = vote.value if vote else 0
+        with self._lock:
+            known = self._known(key)
+            previous = previous if known is None else known
+            if previous == value:
+                return False
+            self._seen.set(key, value)
+            self._deltas[post_id] += value - previous
+            self._pending[key] = value
+        self._start()
+        return True
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='vote-flusher')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Vote flush failed')
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, defaultdict(int)
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return 0
+            try:
+                return self._write(deltas, pending)
+            except Exception:
+                # Put the batch back for the next flush; votes cast since
+                # are newer and keep their place.
+                with self._lock:
+                    for post_id, delta in deltas.items():
+                        self._deltas[post_id] += delta
+                    for key, value in pending.items():
+                        self._pending.setdefault(key, value)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _write(self, deltas, pending):
+        deltas = [{'id': post_id, 'delta': delta} for post_id, delta in deltas.items() if delta]
+        votes = [{'user_id': user_id, 'post_id': post_id, 'value': value}
+                 for (user_id, post_id), value in pending.items()]
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                if deltas:
+                    connection.execute(text(
+                        'UPDATE posts SET votes = COALESCE(votes, 0) + :delta, '
+                        'hot = hot_score(COALESCE(votes, 0) + :delta, timestamp) WHERE id = :id'), deltas)
+                connection.execute(text(
+                    'INSERT OR REPLACE INTO votes (user_id, post_id, value) '
+                    'VALUES (:user_id, :post_id, :value)'), votes)
+                genres = []
+                if deltas:
+                    genres = connection.execute(text(
+                        'SELECT DISTINCT genre_id FROM posts WHERE id IN (%s)' %
+                        ','.join(str(int(d['id'])) for d in deltas))).fetchall()
+                    bump_versions(['post:%d' % d['id'] for d in deltas] +
+                                  ['breed:%s' % genre_id for (genre_id,) in genres], connection)
+            for (genre_id,) in genres:
+                fragment_cache.invalidate('board:%s' % genre_id)
+        return len(votes)
+
+
+@per_app
+def vote_buffer(app):
+    buffer = VoteBuffer(app, app.config['VOTE_FLUSH_INTERVAL'], app.config['VOTE_DEDUPE_SIZE'])
+    atexit.register(buffer.flush)
+    return buffer
+
+
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+def rewrite_css_urls(css, source):
+    # Bundled CSS lives in a different directory from its sources, so point
+    # relative url()s (fonts, images) at their original files. They stay
+    # relative so bundles work under a tenant's path prefix too.
+    base = posixpath.dirname(source)
+
+    def rebase(match):
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+        path, suffix = re.match(r'^([^?#]*)(.*)$', url).groups()
+        resolved = posixpath.relpath(posixpath.normpath(posixpath.join(base, path)), current_app.config['ASSET_DIR'])
+        return 'url(%s)' % json.dumps(resolved + suffix)
+    return CSS_URL.sub(rebase, css)
+
+
+def asset_manifest():
+    state = app_state()
+    if 'asset_manifest' not in state:
+        path = os.path.join(current_app.static_folder, current_app.config['ASSET_DIR'], 'manifest.json')
+        try:
+            with open(path) as f:
+                state['asset_manifest'] = json.load(f)
+        except (IOError, OSError, ValueError):
+            state['asset_manifest'] = {}
+    return state['asset_manifest']
+
+
+@views.app_template_global()
+def asset_url(name):
+    """URL of a built bundle, or None when build_assets has not been run."""
+    filename = asset_manifest().get(name)
+    if filename is None:
+        return None
+    return url_for('dist_asset', filename=filename)
+
+
+def search_match(q, genre_id=None):
+    # Quote every term so user input can never be parsed as FTS5 syntax.
+    terms = ['"%s"' % term.replace('"', '""') for term in q.split()]
+    if not terms:
+        return None
+    match = '{title body} : (%s)' % ' AND '.join(terms)
+    if genre_id is not None:
+        match = 'genre : g%d AND %s' % (genre_id, match)
+    return match
+
+
+def search(q, genre_id=None, page=1, per_page=20):
+    match = search_match(q, genre_id)
+    if match is None:
+        return []
+    rows = db.session.execute(text(
+        'SELECT rowid, kind, post_id, title, body, bm25(search, 10.0, 1.0, 0.0) AS rank '
+        'FROM search WHERE search MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset'),
+        {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page})
+    return [{'id': row.rowid // 2, 'kind': row.kind, 'post_id': row.post_id,
+             'title': row.title, 'body': row.body, 'rank': row.rank} for row in rows]
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+class LazyKeysetPage(object):
+    # A forward page whose rows are yielded as the query cursor advances,
+    # for streamed templates. The cursors are only known once the rows have
+    # been iterated, which a template rendering its pager below the listing
+    # always has.
+    def __init__(self, query, per_page, has_prev, cursor):
+        self.items = self._iterate(query, per_page, has_prev, cursor)
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    def _iterate(self, query, per_page, has_prev, cursor):
+        last = None
+        for count, row in enumerate(query.limit(per_page + 1)):
+            if count == per_page:
+                self.next_cursor = cursor(last)
+                break
+            if count == 0 and has_prev:
+                self.prev_cursor = cursor(row)
+            last = row
+            yield row
+
+
+def parse_cursor(value, columns):
+    try:
+        parts = value.split('_')
+        if len(parts) != len(columns):
+            return None
+        return tuple(column.type.python_type(part) for column, part in zip(columns, parts))
+    except (AttributeError, ValueError):
+        return None
+
+
+def page_size():
+    per_page = request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int)
+    return max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+
+def keyset_page(query, *columns, **kwargs):
+    # Seek on indexed columns instead of OFFSET so every page costs the
+    # same no matter how deep into the listing the reader is. Extra columns
+    # (e.g. hot, id) break ties in the leading one; cursors join the values
+    # of the boundary row with underscores. lazy=True streams forward pages
+    # (see LazyKeysetPage).
+    descending = kwargs.get('descending', False)
+    per_page = page_size()
+    after = parse_cursor(request.args.get('after'), columns)
+    before = parse_cursor(request.args.get('before'), columns)
+    key = tuple_(*columns) if len(columns) > 1 else columns[0]
+
+    def bound(values):
+        return tuple_(*values) if len(values) > 1 else values[0]
+
+    forward = before is None
+    if not forward:
+        query = query.filter(key > bound(before) if descending else key < bound(before))
+    elif after is not None:
+        query = query.filter(key < bound(after) if descending else key > bound(after))
+    if forward == descending:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*[column.asc() for column in columns])
+
+    def cursor(row):
+        return '_'.join(str(getattr(row, column.key)) for column in columns)
+
+    if forward and kwargs.get('lazy'):
+        return LazyKeysetPage(query, per_page, after is not None, cursor)
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows, None, None)
+
+    first, last = cursor(rows[0]), cursor(rows[-1])
+    if forward:
+        next_cursor = last if more else None
+        prev_cursor = first if after is not None else None
+    else:
+        next_cursor = last
+        prev_cursor = first if more else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+
+def post_page(query):
+    # Newest-first pages of posts that run on into the archive. Each page
+    # seeks both stores from the same cursor and merges them by id, so pages
+    # fill up and both cursors carry across the boundary.
+    archive = archive_session()
+    if archive is None:
+        return keyset_page(query, Post.id, descending=True)
+    per_page = page_size()
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    rows = []
+    for store in (query, query.with_session(archive)):
+        if before is not None:
+            store = store.filter(Post.id > before).order_by(Post.id.asc())
+        else:
+            store = (store.filter(Post.id < after) if after is not None else store).order_by(Post.id.desc())
+        rows.extend(store.limit(per_page + 1).all())
+    rows.sort(key=lambda row: row.id, reverse=before is None)
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows, None, None)
+    first, last = str(rows[0].id), str(rows[-1].id)
+    if before is not None:
+        return KeysetPage(rows, last, first if more else None)
+    return KeysetPage(rows, last if more else None, first if after is not None else None)
+
+
+@views.teardown_app_request
+def close_archive_session(exc):
+    archive = g.pop('archive_session', None)
+    if archive is not None:
+        archive.close()
+
+def buffered(fragments, size):
+    buffer, length = [], 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def gzip_stream(chunks, level):
+    # A sync flush after every chunk keeps the compressed stream as
+    # incremental as the page itself.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page while it renders."""
+    app = current_app._get_current_object()
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+    # The session cookie goes out with the headers, before the body is
+    # rendered, so settle anything the templates would store in it now.
+    get_flashed_messages()
+    if app.config.get('WTF_CSRF_ENABLED', True) and any(isinstance(value, Form) for value in context.values()):
+        generate_csrf()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    body = buffered(template.generate(context), app.config['STREAM_CHUNK_SIZE'])
+    compress = bool(request.accept_encodings['gzip'])
+    if compress:
+        body = gzip_stream(body, app.config['STREAM_GZIP_LEVEL'])
+    response = Response(stream_with_context(body), mimetype='text/html')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@views.app_template_global()
+def page_url(**cursor):
+    # Keep the current view args and filters (e.g. ?sort=) but swap the cursor.
+    args = dict((name, request.args[name]) for name in PAGE_ARGS
+                if name in request.args and name not in ('after', 'before'))
+    args.update(request.view_args)
+    args.update(cursor)
+    return url_for(request.endpoint, **args)
+
+
+# Field names the JSON API exposes for each resource, mapped to the columns
+# that back them; ?fields= picks a subset and only those columns are read.
+API_FIELDS = {
+    'genre': OrderedDict([('id', Genre.id), ('name', Genre.name), ('post_count', Genre.post_count),
+                          ('last_post_at', Genre.last_post_at)]),
+    'post': OrderedDict([('id', Post.id), ('genre_id', Post.genre_id), ('user_id', Post.user_id),
+                         ('name', Post.name), ('content', Post.content), ('votes', Post.votes),
+                         ('hot', Post.hot), ('comment_count', Post.comment_count), ('timestamp', Post.timestamp)]),
+    'comment': OrderedDict([('id', Comment.id), ('post_id', Comment.posts_id), ('user_id', Comment.user_id),
+                            ('author', Comment.whoPosted), ('content', Comment.content)]),
+    'breeder': OrderedDict([('name', User.name), ('zip', User.homeTown), ('bio', User.bio),
+                            ('lat', User.lat), ('lon', User.lon), ('distance', None)]),
+}
+
+
+def api_fields(resource):
+    available = API_FIELDS[resource]
+    requested = request.args.get('fields')
+    if not requested:
+        return list(available), None
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        return None, (jsonify(error='unknown fields: %s' % ', '.join(unknown), fields=list(available)), 400)
+    return names, None
+
+
+def api_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def api_listing(resource, query, *keys, **kwargs):
+    # Streams {"data": [...], "next": cursor} row by row straight off the
+    # cursor, so a page of API_MAX_LIMIT rows is never built up in memory.
+    # Pass ?cursor=<next> to continue after the last row.
+    descending = kwargs.get('descending', False)
+    names, error = api_fields(resource)
+    if error:
+        return error
+    limit = max(1, min(request.args.get('limit', current_app.config['PAGE_SIZE'], type=int),
+                       current_app.config['API_MAX_LIMIT']))
+    if request.args.get('cursor'):
+        after = parse_cursor(request.args['cursor'], keys)
+        if after is None:
+            return jsonify(error='invalid cursor'), 400
+        key = tuple_(*keys) if len(keys) > 1 else keys[0]
+        bound = tuple_(*after) if len(after) > 1 else after[0]
+        query = query.filter(key < bound if descending else key > bound)
+    columns = [API_FIELDS[resource][name] for name in names]
+    query = query.with_entities(*(columns + list(keys))) \
+        .order_by(*[key.desc() if descending else key.asc() for key in keys]).limit(limit + 1)
+
+    def generate():
+        yield '{"data": ['
+        last = next_cursor = None
+        for count, row in enumerate(query.yield_per(100)):
+            if count == limit:
+                next_cursor = '_'.join(str(value) for value in last)
+                break
+            yield (',' if count else '') + json.dumps(dict(zip(names, map(api_value, row[:len(names)]))))
+            last = row[len(names):]
+        yield '], "next": %s}' % json.dumps(next_cursor)
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
 class PostForm(Form):
     genre = SelectField('Breed', coerce=int, validators=[DataRequired()])
     name = StringField('Name of Post?', validators=[Required()])
@@ -97,45 +1758,319 @@ class GenreForm(Form):
     submit = SubmitField('Submit')
 
 
-@app.errorhandler(404)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class RequestMetrics(object):
+    # Per-endpoint request latency, SQL and template timings, exposed in the
+    # Prometheus text format at /metrics.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(Histogram)
+        self.templates = defaultdict(Histogram)
+        self.requests = defaultdict(int)
+        self.sql_statements = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+
+    def record(self, endpoint, status, seconds, statements, sql_seconds, template_seconds):
+        with self._lock:
+            self.latency[endpoint].observe(seconds)
+            self.templates[endpoint].observe(template_seconds)
+            self.requests[(endpoint, status)] += 1
+            self.sql_statements[endpoint] += statements
+            self.sql_seconds[endpoint] += sql_seconds
+
+    def render(self):
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s histogram' % name)
+            for endpoint, hist in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, cumulative))
+                lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (name, endpoint, hist.count))
+                lines.append('%s_sum{endpoint="%s"} %f' % (name, endpoint, hist.sum))
+                lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, hist.count))
+
+        def counter(name, help_text, series):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in sorted(series.items()):
+                lines.append('%s{%s} %s' % (name, labels, value))
+
+        with self._lock:
+            histogram('request_duration_seconds', 'Time spent handling a request.', self.latency)
+            histogram('template_render_seconds', 'Time spent rendering templates per request.', self.templates)
+            counter('requests_total', 'Requests handled.', dict(
+                ('endpoint="%s",status="%s"' % key, value) for key, value in self.requests.items()))
+            counter('sql_statements_total', 'SQL statements executed.', dict(
+                ('endpoint="%s"' % key, value) for key, value in self.sql_statements.items()))
+            counter('sql_duration_seconds_total', 'Time spent executing SQL.', dict(
+                ('endpoint="%s"' % key, '%f' % value) for key, value in self.sql_seconds.items()))
+        counter('fragment_cache_total', 'Fragment cache lookups.', {
+            'result="hit"': fragment_cache.hits, 'result="miss"': fragment_cache.misses})
+        return '\n'.join(lines) + '\n'
+
+
+@per_app
+def metrics(app):
+    return RequestMetrics()
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            self._timed(started)
+
+    def generate(self, *args, **kwargs):
+        # Streamed pages render between chunks; only the time spent here counts.
+        fragments = Template.generate(self, *args, **kwargs)
+        while True:
+            started = time.perf_counter()
+            try:
+                fragment = next(fragments)
+            except StopIteration:
+                return
+            finally:
+                self._timed(started)
+            yield fragment
+
+    def _timed(self, started):
+        if has_request_context() and 'metrics_started' in g:
+            g.template_seconds += time.perf_counter() - started
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+    if has_request_context() and 'metrics_started' in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+        if g.slow_log is not None and len(g.slow_log) < current_app.config['SLOW_REQUEST_MAX_STATEMENTS']:
+            g.slow_log.append((elapsed, statement, parameters))
+        if g.statement_shapes is not None:
+            g.statement_shapes[statement_shape(statement)] += 1
+
+
+@views.before_app_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    g.template_seconds = 0.0
+    sampled = current_app.config['SLOW_REQUEST_THRESHOLD'] is not None and \
+        random.random() < current_app.config['SLOW_REQUEST_SAMPLE_RATE']
+    g.slow_log = [] if sampled else None
+    g.statement_shapes = defaultdict(int) if query_checks_enabled() else None
+
+
+@views.after_app_request
+def record_request_metrics(response):
+    if 'metrics_started' not in g:
+        return response
+    record = partial(finish_request_metrics, current_app._get_current_object(), metrics._get_current_object(),
+                     g._get_current_object(), request.endpoint or 'unmatched', request.method, request.full_path,
+                     response.status_code)
+    if response.is_streamed:
+        # Streamed pages render and run lazy queries while the body is
+        # sent, so the totals are only final once the stream is closed.
+        response.call_on_close(record)
+    else:
+        record()
+        if g.statement_shapes is not None:
+            response.headers['X-Query-Count'] = str(g.sql_statements)
+    return response
+
+
+def finish_request_metrics(app, metrics, stats, endpoint, method, path, status):
+    seconds = time.perf_counter() - stats.metrics_started
+    metrics.record(endpoint, status, seconds, stats.sql_statements, stats.sql_seconds, stats.template_seconds)
+    if stats.slow_log is not None and seconds >= app.config['SLOW_REQUEST_THRESHOLD']:
+        app.logger.warning('Slow request %s %s: %.1f ms, %d statements (%.1f ms SQL), %.1f ms templates\n%s',
+                           method, path, seconds * 1000, stats.sql_statements,
+                           stats.sql_seconds * 1000, stats.template_seconds * 1000,
+                           '\n'.join('  %.1f ms  %s  %r' % (elapsed * 1000, statement, parameters)
+                                     for elapsed, statement, parameters in stats.slow_log))
+    if stats.statement_shapes is not None:
+        check_queries(app, stats, endpoint, path)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_checks_enabled():
+    enabled = current_app.config['QUERY_CHECKS']
+    return current_app.debug or current_app.testing if enabled is None else enabled
+
+
+def statement_shape(statement):
+    # Collapse IN lists so a page of 10 and a page of 25 share one shape.
+    return re.sub(r'\((?:\?, )*\?\)', '(?)', ' '.join(statement.split()))
+
+
+def query_budget(statements):
+    # Declares how many SQL statements one request to the view may issue;
+    # checked when QUERY_CHECKS is on (by default in debug and testing).
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.query_budget = statements
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def unchecked_queries(view):
+    # For long-lived streams that poll: repeating one statement is their
+    # job, not an N+1.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.statement_shapes = None
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def check_queries(app, stats, endpoint, path):
+    budget = stats.get('query_budget')
+    repeated = sorted((count, shape) for shape, count in stats.statement_shapes.items()
+                      if count >= app.config['N_PLUS_ONE_THRESHOLD'])
+    problems = []
+    if budget is not None and stats.sql_statements > budget:
+        problems.append('%d statements over a budget of %d' % (stats.sql_statements, budget))
+    problems.extend('%d x %s' % (count, shape) for count, shape in reversed(repeated))
+    app.extensions['flaskapp']['last_query_check'] = (endpoint, stats.sql_statements, budget, problems)
+    if not problems:
+        return
+    message = 'Query check failed for %s (%s):\n  %s' % (endpoint, path, '\n  '.join(problems))
+    strict = app.config['QUERY_BUDGET_STRICT']
+    if app.testing if strict is None else strict:
+        raise QueryBudgetExceeded(message)
+    app.logger.warning(message)
+
+
+@views.route('/metrics', methods=['GET'])
+def Metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@views.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@views.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
 
-@app.route('/New Post', methods=['GET', 'POST'])
+@views.route('/New Post', methods=['GET', 'POST'])
 def NewPost():
     form = PostForm()
     form.genre.choices = [(a.id, a.name) for a in Genre.query.order_by(Genre.name)]
-    name = session['user']
-    userDetails = User.query.filter_by(name=name).first()
+    userDetails = current_user()
     if form.validate_on_submit():
         newPost = Post(genre_id=form.genre.data, user_id = userDetails.id, name=form.name.data, content=form.content.data)
+        newPost.votes = 0
+        newPost.timestamp = datetime.utcnow()
+        newPost.hot = hot_score(newPost.votes, newPost.timestamp)
         db.session.add(newPost)
+        Genre.query.filter_by(id=newPost.genre_id).update(
+            {Genre.post_count: func.coalesce(Genre.post_count, 0) + 1, Genre.last_post_at: newPost.timestamp},
+            synchronize_session=False)
+        invalidate_on_commit('board:%d' % newPost.genre_id)
+        invalidate_on_commit('boards')
+        bump_versions(['breed:%d' % newPost.genre_id, 'boards', 'user:%s' % userDetails.name])
         flash('Added Post to database!')
         return redirect(url_for('NewPost'))
     return render_template('New Post.html', form=form)
 
-@app.route('/Show Post/<id>', methods=['GET', 'POST'])
+@views.route('/Show Post/<int:id>', methods=['GET', 'POST'])
+@query_budget(6)
+@conditional(lambda id: ['post:%d' % id, 'thread:%d' % id], form=True)
 def ShowPost(id):
     form = CommentForm()
     Posts = Post.query.filter_by(id=id).first()
-    name = session['user']
-    userDetails = User.query.filter_by(name=name).first()
-    postComments = Comment.query.filter_by(posts_id=id)
+    comments = Comment.query
+    archived = Posts is None and archive_session() is not None
+    if archived:
+        Posts = Post.query.with_session(archive_session()).filter_by(id=id).first()
+        comments = Comment.query.with_session(archive_session())
+    if Posts is None:
+        abort(404)
+    userDetails = current_user()
+    if archived and form.is_submitted():
+        flash('This thread is archived and closed to new comments.')
+        return redirect(url_for('ShowPost', id=id))
     if form.validate_on_submit():
         newComment = Comment(posts_id=id, user_id=userDetails.id, content=form.content.data, whoPosted = userDetails.name)
         db.session.add(newComment)
+        Post.query.filter_by(id=id).update(
+            {Post.comment_count: func.coalesce(Post.comment_count, 0) + 1}, synchronize_session=False)
+        db.session.flush()
+        invalidate_on_commit('board:%d' % Posts.genre_id)
+        publish_on_commit(newComment)
+        bump_versions(['thread:%d' % id, 'breed:%d' % Posts.genre_id])
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return render_template('Comment.html', comment=newComment), 201
         flash('Added Comment to database!')
-        return redirect(url_for('ShowPost' , postDetails=Posts , id=id, postComments=postComments))
-    return render_template('Show Post.html', postDetails=Posts, id=id, postComments=postComments, form=form)
+        return redirect(url_for('ShowPost', id=id))
+    if form.is_submitted() and request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(errors=form.errors), 400
+    page = keyset_page(comments.filter_by(posts_id=id), Comment.id, lazy=current_app.config['STREAM_TEMPLATES'])
+    postComments = page.items
+    return stream_template('Show Post.html', postDetails=Posts, id=id, postComments=postComments, page=page, form=form,
+                           archived=archived)
 
+@views.route('/Show Post/<int:id>/events')
+@unchecked_queries
+def ShowPostEvents(id):
+    # EventSource sends Last-Event-ID on reconnect; the page passes ?after on the first connect.
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', 0, type=int)
+    response = Response(stream_with_context(comment_events(id, after)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
+@views.route('/Show Post/<int:id>/comments')
+@read_only
+def ShowPostComments(id):
+    after = request.args.get('after', 0, type=int)
+    comments = Comment.query.filter(Comment.posts_id == id, Comment.id > after) \
+        .order_by(Comment.id).limit(current_app.config['MAX_PAGE_SIZE']).all()
+    return render_template('Comments.html', comments=comments)
 
-@app.route('/New Genre', methods=['GET', 'POST'])
+
+
+@views.route('/New Genre', methods=['GET', 'POST'])
 def NewGenre():
     form = GenreForm()
     if form.validate_on_submit():
@@ -143,96 +2078,743 @@ def NewGenre():
         if newGenre is None:
             newGenre = Genre(name=form.name.data)
             db.session.add(newGenre)
+            invalidate_on_commit('boards')
+            bump_versions(['boards'])
             flash('Added Genre to database!')
         return redirect(url_for('NewGenre'))
     return render_template('New Breed.html', form=form)
 
-@app.route('/New Artist', methods=['GET', 'POST'])
+@views.route('/New Artist', methods=['GET', 'POST'])
 def NewArtist():
     form = ArtistSignUpForm()
     if form.validate_on_submit():
+        throttle_credentials(form.email.data)
         newArtist = User.query.filter_by(name=form.email.data).first()
         if newArtist is None and (form.password1.data == form.password2.data):
-            newArtist = User(name=form.email.data, password=form.password1.data, homeTown=form.hometown.data, bio=form.bio.data, is_musician = True)
-            session['user'] = form.email.data
-            session['logged_in'] = True
+            newArtist = User(name=form.email.data, password=password_hasher.hash(form.password1.data), homeTown=form.hometown.data, bio=form.bio.data, is_musician = True)
             db.session.add(newArtist)
+            db.session.flush()
+            login_user(newArtist)
             flash('Added Artist to database!')
         return redirect(url_for('UserPage'))
     return render_template('New Breeder.html', form=form)
 
-@app.route('/Login', methods=['GET', 'POST'])
+@views.route('/Login', methods=['GET', 'POST'])
 def Login():
     form = LoginForm()
     if form.validate_on_submit():
+        throttle_credentials(form.email.data)
         userName = User.query.filter_by(name=form.email.data).first()
-        if (form.password.data == userName.password):
-            session['user'] = form.email.data
-            session['logged_in'] = True
+        if userName is not None and check_password(userName, form.password.data):
+            login_user(userName)
             return redirect(url_for('UserPage'))
         flash('Wrong Login Details!')
     return render_template('Login.html', form=form)
 
-@app.route('/Logout', methods=['GET', 'POST'])
+@views.route('/Logout', methods=['GET', 'POST'])
 def Logout():
-    session['logged_in'] = False
+    session.clear()
     return render_template('index.html')
 
-@app.route('/New User', methods=['GET', 'POST'])
+@views.route('/New User', methods=['GET', 'POST'])
 def NewUser():
     form = ArtistSignUpForm()
     if form.validate_on_submit():
+        throttle_credentials(form.email.data)
         newUser = User.query.filter_by(name=form.email.data).first()
         if newUser is None and (form.password1.data == form.password2.data):
-            newUser = User(name=form.email.data, password=form.password1.data, homeTown=form.hometown.data, bio=form.bio.data, is_musician = False)
-            session['user'] = form.email.data
-            session['logged_in'] = True
+            newUser = User(name=form.email.data, password=password_hasher.hash(form.password1.data), homeTown=form.hometown.data, bio=form.bio.data, is_musician = False)
             db.session.add(newUser)
+            db.session.flush()
+            login_user(newUser)
             flash('Added User to database!')
         return redirect(url_for('UserPage'))
     return render_template('New User.html', form=form)
 
-@app.route('/User Page', methods=['GET', 'POST'])
+@views.route('/User Page', methods=['GET', 'POST'])
+@query_budget(3)
+@conditional(lambda: ['user:%s' % session.get('user')])
 def UserPage():
-    name = session['user']
-    allDetails = User.query.filter_by(name=name).first()
-    userPosts = Post.query.filter_by(user_id=allDetails.id)
-    return render_template('User Page.html', allDetails=allDetails, userPosts = userPosts)
+    allDetails = current_user()
+    page = keyset_page(Post.query.filter_by(user_id=allDetails.id), Post.id, descending=True)
+    userPosts = page.items
+    return render_template('User Page.html', allDetails=allDetails, userPosts = userPosts, page=page)
 
-@app.route('/All Breeds', methods=['GET', 'POST'])
+@views.route('/All Breeds', methods=['GET', 'POST'])
+@read_only
 def AllBoards():
-    allBoards = Genre.query.all()
-    return render_template('All Breeds.html', allBoards=allBoards)
+    def render():
+        allBoards = Genre.query.all()
+        return render_template('All Breeds List.html', allBoards=allBoards)
+    boardList = fragment_cache.render('boards', '', render, ['boards'])
+    return render_template('All Breeds.html', boardList=boardList)
 
-@app.route('/Breed/<id>', methods=['GET', 'POST'])
+@views.route('/Breed/<int:id>', methods=['GET', 'POST'])
+@query_budget(4)
+@read_only
+@conditional(lambda id: ['breed:%d' % id])
 def Board(id):
-    Posts = Post.query.filter_by(genre_id=id)
-    thisBoard = Genre.query.filter_by(id=id).first()
-    return render_template('Board.html', Posts=Posts, thisBoard=thisBoard)
+    def render():
+        thisBoard = Genre.query.filter_by(id=id).first()
+        if thisBoard is None:
+            abort(404)
+        if request.args.get('sort') == 'hot':
+            page = keyset_page(Post.query.filter_by(genre_id=id), Post.hot, Post.id, descending=True)
+        else:
+            page = keyset_page(Post.query.filter_by(genre_id=id), Post.id, descending=True)
+        Posts = page.items
+        return render_template('Board Posts.html', Posts=Posts, thisBoard=thisBoard, page=page)
+    boardPosts = fragment_cache.render('board:%d' % id, cursor_key(), render, ['breed:%d' % id])
+    return stream_template('Board.html', boardPosts=boardPosts)
+
+@views.route('/Upvote/<int:id>', methods=['POST'])
+def Upvote(id):
+    return castVote(id, 1)
+
+@views.route('/Downvote/<int:id>', methods=['POST'])
+def Downvote(id):
+    return castVote(id, -1)
+
+def castVote(id, value):
+    userDetails = current_user()
+    if userDetails is None or not session.get('logged_in'):
+        return jsonify(error='login required'), 401
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        # The session cookie alone would let any site vote as the visitor.
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError as e:
+            return jsonify(error=str(e)), 400
+    if db.session.query(Post.id).filter_by(id=id).first() is None:
+        return jsonify(error='no such post'), 404
+    counted = vote_buffer.record(userDetails.id, id, value)
+    return jsonify(post=id, vote=value, counted=counted), 202
+
+@views.route('/Search', methods=['GET'])
+def Search():
+    q = request.args.get('q', '')
+    breed = request.args.get('breed', type=int)
+    page = max(1, request.args.get('page', 1, type=int))
+    results = search(q, breed, page, current_app.config['SEARCH_PAGE_SIZE'])
+    allBoards = Genre.query.order_by(Genre.name)
+    return render_template('Search.html', q=q, breed=breed, page=page, results=results,
+                           allBoards=allBoards, per_page=current_app.config['SEARCH_PAGE_SIZE'])
 
-@app.route('/UserOrArtist', methods=['GET', 'POST'])
+@views.route('/api/search', methods=['GET'])
+def SearchApi():
+    q = request.args.get('q', '')
+    breed = request.args.get('breed', type=int)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = max(1, min(request.args.get('per_page', current_app.config['SEARCH_PAGE_SIZE'], type=int),
+                          current_app.config['MAX_PAGE_SIZE']))
+    return jsonify(q=q, breed=breed, page=page, results=search(q, breed, page, per_page))
+
+@views.route('/UserOrArtist', methods=['GET', 'POST'])
 def UserOrArtist():
     return render_template('UserOrBreeder.html')
 
-@app.route('/Breeder List', methods=['GET'])
+@views.route('/Breeder List', methods=['GET'])
 def ArtistList():
-    name = session['user']
-    userDetails = User.query.filter_by(name=name).first()
+    userDetails = current_user()
     allArtists = User.query.filter_by(is_musician=True)
-    localArtists = User.query.filter_by(homeTown = userDetails.homeTown, is_musician=True)
+    localArtists = []
+    if userDetails is not None:
+        localArtists = nearby_breeders(userDetails.homeTown, current_app.config['NEARBY_RADIUS_MILES'], current_app.config['NEARBY_LIMIT'])
     return render_template('Breeder List.html', allArtists=allArtists, localArtists = localArtists)
 
-@app.route('/Breeder Details/<name>', methods=['GET', 'POST'])
+def radius_arg():
+    # float() accepts 'nan' and 'inf', which the grid maths cannot.
+    miles = request.args.get('radius', current_app.config['NEARBY_RADIUS_MILES'], type=float)
+    if not math.isfinite(miles) or miles <= 0:
+        return None
+    return min(miles, 500)
+
+@views.route('/api/breeders/near', methods=['GET'])
+def NearbyBreedersApi():
+    zip_code = request.args.get('zip', type=int)
+    miles = radius_arg()
+    if miles is None:
+        return jsonify(error='radius must be a positive number of miles'), 400
+    limit = max(1, min(request.args.get('limit', current_app.config['NEARBY_LIMIT'], type=int), current_app.config['MAX_PAGE_SIZE']))
+    if zip_code is None:
+        return jsonify(error='zip is required'), 400
+    breeders = nearby_breeders(zip_code, miles, limit)
+    return jsonify(zip=zip_code, radius=miles, breeders=[
+        {'name': breeder.name, 'zip': breeder.homeTown, 'bio': breeder.bio,
+         'distance': round(breeder.distance, 1)} for breeder in breeders])
+
+@views.route('/api/v1/genres', methods=['GET'])
+@read_only
+def GenresApi():
+    return api_listing('genre', Genre.query, Genre.id)
+
+@views.route('/api/v1/genres/<int:id>/posts', methods=['GET'])
+@read_only
+def GenrePostsApi(id):
+    if request.args.get('sort') == 'hot':
+        return api_listing('post', Post.query.filter_by(genre_id=id), Post.hot, Post.id, descending=True)
+    return api_listing('post', Post.query.filter_by(genre_id=id), Post.id, descending=True)
+
+@views.route('/api/v1/posts/<int:id>/comments', methods=['GET'])
+@read_only
+def PostCommentsApi(id):
+    return api_listing('comment', Comment.query.filter_by(posts_id=id), Comment.id)
+
+@views.route('/api/v1/breeders', methods=['GET'])
+@read_only
+def BreedersApi():
+    zip_code = request.args.get('zip', type=int)
+    if zip_code is None:
+        return jsonify(error='zip is required'), 400
+    names, error = api_fields('breeder')
+    if error:
+        return error
+    miles = radius_arg()
+    if miles is None:
+        return jsonify(error='radius must be a positive number of miles'), 400
+    limit = max(1, min(request.args.get('limit', current_app.config['NEARBY_LIMIT'], type=int),
+                       current_app.config['MAX_PAGE_SIZE']))
+    breeders = nearby_breeders(zip_code, miles, limit)
+    return jsonify(zip=zip_code, radius=miles, data=[
+        dict((name, round(breeder.distance, 1) if name == 'distance' else
+              getattr(breeder, API_FIELDS['breeder'][name].key)) for name in names) for breeder in breeders])
+
+@views.route('/Breeder Details/<name>', methods=['GET', 'POST'])
+@read_only
+@conditional(lambda name: ['user:%s' % name])
 def ArtistDetails(name):
     allArtists = User.query.filter_by(name = name).first()
-    artistPosts = Post.query.filter_by(user_id=allArtists.id)
-    return render_template('Breeder Details.html', allArtists=allArtists, artistPosts=artistPosts)
+    page = post_page(Post.query.filter_by(user_id=allArtists.id))
+    artistPosts = page.items
+    return render_template('Breeder Details.html', allArtists=allArtists, artistPosts=artistPosts, page=page)
+
+
+@views.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+    # Bundles are content-hashed, so a name never changes meaning and can be
+    # cached forever; serve the prebuilt .gz when the client accepts gzip.
+    directory = os.path.join(current_app.static_folder, current_app.config['ASSET_DIR'])
+    encoded = request.accept_encodings['gzip'] and \
+        os.path.isfile(os.path.join(directory, filename + '.gz'))
+    if encoded:
+        response = send_from_directory(directory, filename + '.gz', mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(directory, filename)
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % current_app.config['ASSET_MAX_AGE']
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@views.route('/Cache Stats', methods=['GET'])
+def CacheStats():
+    return jsonify(fragment_cache.stats())
 
 
-@app.route('/', methods=['GET', 'POST'])
+@views.route('/', methods=['GET', 'POST'])
 def index():
     return render_template('index.html')
 
 
+@manager.option('-H', '--host', dest='host', default='127.0.0.1')
+@manager.option('-p', '--port', dest='port', type=int, default=5000)
+def serve_tenants(host, port):
+    """Serve every tenant from one process, dispatched by host or path prefix."""
+    run_simple(host, port, create_tenants_app(), threaded=True)
+
+
+@manager.command
+def compile_templates():
+    """Fill the Jinja bytecode cache so new workers skip template compilation."""
+    env = current_app.jinja_env
+    for name in env.list_templates(filter_func=lambda name: name.endswith('.html')):
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError as e:
+            print('Skipped %s: %s' % (name, e))
+
+
+@manager.command
+def check_query_budgets():
+    """Request each budgeted page against the current database and report its SQL statements."""
+    app = current_app._get_current_object()
+    post = Post.query.order_by(Post.comment_count.desc()).first()
+    user = User.query.join(Post, Post.user_id == User.id).first()
+    if post is None or user is None:
+        sys.exit('Need at least one post to check against')
+    pages = [('Board', url_for('Board', id=post.genre_id)),
+             ('ShowPost', url_for('ShowPost', id=post.id)),
+             ('UserPage', url_for('UserPage'))]
+    config = dict((key, app.config[key]) for key in ('QUERY_CHECKS', 'QUERY_BUDGET_STRICT'))
+    app.config.update(QUERY_CHECKS=True, QUERY_BUDGET_STRICT=False)
+    failed = False
+    try:
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s['user'] = user.name
+            s['user_id'] = user.id
+            s['logged_in'] = True
+        for endpoint, url in pages:
+            # Cold caches show the worst case a page can hit.
+            fragment_cache.invalidate('board:%d' % post.genre_id)
+            user_cache.clear()
+            client.get(url, buffered=True)
+            _, statements, budget, problems = app_state()['last_query_check']
+            print('%-10s %3d / %d statements' % (endpoint, statements, budget))
+            for problem in problems:
+                print('    ' + problem)
+            failed = failed or bool(problems)
+    finally:
+        app.config.update(config)
+    if failed:
+        sys.exit(1)
+
+
+@manager.command
+def create_indexes():
+    """Add any missing model indexes to an existing database in place."""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    skipped = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            skipped.append(table.name)
+            continue
+        existing = set(ix['name'] for ix in inspector.get_indexes(table.name))
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if not set(column.name for column in index.columns) <= columns:
+                skipped.append(index.name)
+                continue
+            index.create(bind=db.engine)
+            print('Created index %s' % index.name)
+    if skipped:
+        print('Skipped %s: run upgrade_db to add the missing tables and columns' % ', '.join(skipped))
+    db.engine.execute('ANALYZE')
+
+
+@manager.command
+def upgrade_db():
+    """Bring an existing database up to the current models in place."""
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(db.engine.dialect)))
+                print('Added column %s.%s' % (table.name, column.name))
+                added.append(column)
+    db.engine.execute('UPDATE posts SET hot = hot_score(COALESCE(votes, 0), timestamp) WHERE hot IS NULL')
+    for user in User.query.filter(User.cell == None, User.homeTown != None):
+        locate_user(None, None, user)
+    db.session.commit()
+    create_indexes()
+    if added:
+        repair_counters()
+
+
+@manager.command
+def build_assets():
+    """Bundle, fingerprint and precompress the stylesheets and scripts base.html uses."""
+    directory = os.path.join(current_app.static_folder, current_app.config['ASSET_DIR'])
+    missing = [source for sources in current_app.config['ASSET_BUNDLES'].values() for source in sources
+               if not os.path.isfile(os.path.join(current_app.static_folder, source))]
+    if missing:
+        sys.exit('Missing asset sources in %s: %s' % (current_app.static_folder, ', '.join(sorted(missing))))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = {}
+    for name, sources in sorted(current_app.config['ASSET_BUNDLES'].items()):
+        parts = []
+        for source in sources:
+            with open(os.path.join(current_app.static_folder, source), 'rb') as f:
+                content = f.read().decode('utf-8')
+            if name.endswith('.css'):
+                content = rewrite_css_urls(content, source)
+            parts.append('/* %s */\n%s' % (source, content) if name.endswith('.css') else content + ';')
+        data = '\n'.join(parts).encode('utf-8')
+        stem, ext = os.path.splitext(name)
+        filename = '%s.%s%s' % (stem, hashlib.sha1(data).hexdigest()[:12], ext)
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(data)
+        with gzip.GzipFile(os.path.join(directory, filename + '.gz'), 'wb', 9, mtime=0) as f:
+            f.write(data)
+        manifest[name] = filename
+        print('Built %s (%d bytes)' % (filename, len(data)))
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    app_state()['asset_manifest'] = manifest
+
+
+@manager.command
+def repair_counters():
+    """Recompute the denormalised comment and post counters from scratch."""
+    with archive_attached() as (connection, archived):
+        with connection.begin():
+            connection.execute(
+                'UPDATE posts SET comment_count = '
+                '(SELECT COUNT(*) FROM comments WHERE comments.posts_id = posts.id)')
+            # Archived posts still count towards their breed.
+            connection.execute(
+                'UPDATE genres SET '
+                'post_count = (SELECT COUNT(*) FROM posts WHERE posts.genre_id = genres.id)%s, '
+                'last_post_at = COALESCE((SELECT MAX(timestamp) FROM posts WHERE posts.genre_id = genres.id), %s)' % (
+                    (' + (SELECT COUNT(*) FROM archive.posts WHERE posts.genre_id = genres.id)',
+                     '(SELECT MAX(timestamp) FROM archive.posts WHERE posts.genre_id = genres.id)')
+                    if archived else ('', 'NULL')))
+            genre_ids = [row[0] for row in connection.execute('SELECT id FROM genres')]
+            bump_versions(['global'], connection)
+    fragment_cache.invalidate('boards')
+    for genre_id in genre_ids:
+        fragment_cache.invalidate('board:%d' % genre_id)
+
+
+@manager.command
+def rebuild_search():
+    """Repopulate the full-text search index from the posts and comments tables."""
+    db.create_all()
+    with archive_attached() as (connection, archived):
+        with connection.begin():
+            connection.execute('DELETE FROM search')
+            index_search(connection, 'main')
+            if archived:
+                index_search(connection, 'archive')
+            connection.execute("INSERT INTO search (search) VALUES ('optimize')")
+
+
+def index_search(connection, schema, where=''):
+    # OR REPLACE, so indexing a batch of archived rows again is harmless.
+    connection.execute(
+        "INSERT OR REPLACE INTO search (rowid, title, body, genre, kind, post_id) "
+        "SELECT id * 2, name, content, 'g' || genre_id, 'post', id FROM %s.posts %s" % (
+            schema, where.replace('{post_id}', 'id')))
+    connection.execute(
+        "INSERT OR REPLACE INTO search (rowid, title, body, genre, kind, post_id) "
+        "SELECT comments.id * 2 + 1, '', comments.content, 'g' || posts.genre_id, 'comment', comments.posts_id "
+        "FROM %s.comments AS comments LEFT JOIN %s.posts AS posts ON posts.id = comments.posts_id %s" % (
+            schema, schema, where.replace('{post_id}', 'comments.posts_id')))
+
+
+def autoincrement_ids(connection, table):
+    # Tables created before AUTOINCREMENT reuse the highest free rowid, which
+    # after archiving collides with archived ids; rebuild them once.
+    sql = connection.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                             (table.name,)).scalar()
+    if 'AUTOINCREMENT' not in sql.upper():
+        existing = set(row[1] for row in connection.execute('PRAGMA main.table_info(%s)' % table.name))
+        columns = ', '.join('"%s"' % column.name for column in table.columns if column.name in existing)
+        create = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+        # Keep the rename from re-checking comment triggers that name posts
+        # while it is gone.
+        connection.execute('PRAGMA legacy_alter_table = ON')
+        with connection.begin():
+            connection.execute(create.replace('CREATE TABLE %s ' % table.name,
+                                              'CREATE TABLE main.%s_rebuild ' % table.name, 1))
+            connection.execute('INSERT INTO main.%s_rebuild (%s) SELECT %s FROM main.%s' % (
+                table.name, columns, columns, table.name))
+            # Dropping the table drops its indexes and search triggers too.
+            connection.execute('DROP TABLE main.%s' % table.name)
+            connection.execute('ALTER TABLE main.%s_rebuild RENAME TO %s' % (table.name, table.name))
+            for index in table.indexes:
+                index.create(connection)
+            if table.name in ('posts', 'comments'):
+                for statement in SEARCH_DDL[1:]:
+                    connection.execute(statement)
+        connection.execute('PRAGMA legacy_alter_table = OFF')
+        print('Rebuilt %s with AUTOINCREMENT' % table.name)
+    # Raise the sequence past the archive too, including for a table that
+    # is empty and so has no sequence row yet.
+    top = connection.execute('SELECT MAX(COALESCE((SELECT MAX(id) FROM main.%s), 0), '
+                             'COALESCE((SELECT MAX(id) FROM archive.%s), 0))' % (table.name, table.name)).scalar()
+    if not connection.execute('UPDATE main.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?',
+                              (top, table.name)).rowcount:
+        connection.execute('INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)', (table.name, top))
+
+
+@manager.command
+def archive_posts(days=None):
+    """Move posts older than DAYS, with their comments, into the read-only archive file."""
+    config = current_app.config
+    cutoff = datetime.utcnow() - timedelta(days=int(days or config['ARCHIVE_AFTER_DAYS']))
+    tables = [Post.__table__, Comment.__table__]
+    engine = create_engine('sqlite:///' + config['ARCHIVE_DATABASE'])
+    for table in tables:
+        # Per table rather than metadata.create_all, which would also bring
+        # the search index and its triggers into the archive.
+        table.create(engine, checkfirst=True)
+    engine.dispose()
+    columns = dict((table.name, ', '.join('"%s"' % column.name for column in table.columns)) for table in tables)
+    moved = 0
+    with archive_attached() as (connection, _):
+        searchable = connection.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'search'").scalar()
+        for table in tables:
+            autoincrement_ids(connection, table)
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS archiving (id INTEGER PRIMARY KEY)')
+        connection.execute('DELETE FROM archiving')
+        # Rows from before timestamps were recorded are the oldest of all.
+        connection.execute('INSERT INTO archiving SELECT id FROM posts WHERE timestamp < ? OR timestamp IS NULL',
+                           (cutoff,))
+        last = 0
+        while True:
+            ids = [row[0] for row in connection.execute(
+                'SELECT id FROM archiving WHERE id > ? ORDER BY id LIMIT ?', (last, config['ARCHIVE_BATCH_SIZE']))]
+            if not ids:
+                break
+            batch = '{post_id} IN (SELECT id FROM archiving WHERE id BETWEEN %d AND %d)' % (ids[0], ids[-1])
+            # WAL makes a transaction over two files non-atomic, so copy
+            # first and delete once the copy has committed, and only rows the
+            # archive holds. A comment committed in between is picked up by
+            # another round; a run cut short copies the batch again, hence
+            # INSERT OR REPLACE.
+            while True:
+                with connection.begin():
+                    for table, post_id in (('posts', 'id'), ('comments', 'posts_id')):
+                        connection.execute('INSERT OR REPLACE INTO archive.%s (%s) SELECT %s FROM main.%s WHERE %s' % (
+                            table, columns[table], columns[table], table, batch.replace('{post_id}', post_id)))
+                with connection.begin():
+                    for table, post_id in (('comments', 'posts_id'), ('posts', 'id')):
+                        connection.execute('DELETE FROM main.%s WHERE %s AND id IN (SELECT id FROM archive.%s)' % (
+                            table, batch.replace('{post_id}', post_id), table))
+                    if searchable:
+                        # The delete triggers dropped these from search;
+                        # archived threads stay findable.
+                        index_search(connection, 'archive', 'WHERE ' + batch)
+                    bump_versions(['global'], connection)
+                if connection.execute('SELECT 1 FROM main.comments WHERE %s LIMIT 1' % (
+                        batch.replace('{post_id}', 'posts_id'))).scalar() is None:
+                    break
+            moved += len(ids)
+            last = ids[-1]
+        connection.execute('DROP TABLE archiving')
+    if moved:
+        db.engine.execute('ANALYZE')
+        db.engine.execute('VACUUM')
+        fragment_cache.invalidate('boards')
+        for (genre_id,) in db.session.query(Genre.id):
+            fragment_cache.invalidate('board:%d' % genre_id)
+    print('Archived %d posts older than %s' % (moved, cutoff.date()))
+
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+
+
+class JsonlImporter(object):
+    # Streams typed JSONL records ('genre', 'user', 'post', 'comment') into
+    # the database in executemany batches on one raw connection, committing
+    # every IMPORT_TRANSACTION_ROWS rows. Genres and users are referenced by
+    # name; a comment's 'post' is the 'id' of a post record from the same
+    # import, or an existing post id when no such record was imported.
+    # Comments whose post was skipped or does not exist are skipped.
+    ORDER = ('genre', 'user', 'post', 'comment')
+
+    def __init__(self, batch_size, transaction_rows):
+        self.batch_size = batch_size
+        self.transaction_rows = transaction_rows
+        self.buffers = dict((kind, []) for kind in self.ORDER)
+        self.genre_ids = LRUCache(100000)
+        self.user_ids = LRUCache(100000)
+        self.counts = dict((kind, 0) for kind in self.ORDER)
+        self.skipped = 0
+        self.uncommitted = 0
+        self.raw = db.engine.raw_connection()
+        self.connection = self.raw.connection
+        self.connection.isolation_level = None
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS import_post_ids '
+                                '(old INTEGER PRIMARY KEY, new INTEGER)')
+        self.connection.execute('DELETE FROM import_post_ids')
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def add(self, record):
+        kind = record.get('type')
+        if kind not in self.buffers:
+            self.skipped += 1
+            return
+        self.buffers[kind].append(record)
+        if len(self.buffers[kind]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Parents always go in before children so references resolve.
+        for kind in self.ORDER:
+            if self.buffers[kind]:
+                getattr(self, 'insert_%ss' % kind)(self.buffers[kind])
+                self.buffers[kind] = []
+        if self.uncommitted >= self.transaction_rows:
+            self.connection.execute('COMMIT')
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.uncommitted = 0
+
+    def finish(self):
+        self.flush()
+        self.connection.execute('COMMIT')
+        self.connection.isolation_level = ''
+        self.raw.close()
+
+    def resolve(self, cache, table, names):
+        missing = [name for name in set(names) if cache.get(name) is None]
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            rows = self.connection.execute('SELECT name, id FROM %s WHERE name IN (%s)' % (
+                table, ','.join('?' * len(chunk))), chunk)
+            for name, id in rows:
+                cache.set(name, id)
+        return dict((name, cache.get(name)) for name in names)
+
+    def next_id(self, table):
+        top = self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM %s' % table).fetchone()[0]
+        # Past the AUTOINCREMENT sequence too, which covers archived ids.
+        if self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+            row = self.connection.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+            top = max(top, row[0] if row else 0)
+        return top + 1
+
+    def executemany(self, kind, sql, rows):
+        inserted = self.connection.executemany(sql, rows).rowcount
+        self.counts[kind] += inserted
+        self.skipped += len(rows) - inserted
+        self.uncommitted += len(rows)
+
+    def insert_genres(self, records):
+        self.executemany('genre', 'INSERT OR IGNORE INTO genres (name, post_count) VALUES (?, 0)',
+                         [(r['name'],) for r in records])
+
+    def insert_users(self, records):
+        rows = []
+        for r in records:
+            location = zipcodes().get(r.get('homeTown'))
+            lat, lon = location or (None, None)
+            rows.append((r['name'], r.get('password'), r.get('homeTown'), r.get('bio'),
+                         bool(r.get('is_musician')), lat, lon, grid_cell(lat, lon) if location else None))
+        self.executemany('user', 'INSERT OR IGNORE INTO users (name, password, homeTown, bio, is_musician, '
+                         'lat, lon, cell) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def insert_posts(self, records):
+        genres = self.resolve(self.genre_ids, 'genres', [r.get('genre') for r in records])
+        users = self.resolve(self.user_ids, 'users', [r.get('user') for r in records])
+        # Ids are assigned here, inside the write lock, so the old-to-new id
+        # map for comments is known without reading the rows back.
+        id = self.next_id('posts')
+        rows, mapping = [], []
+        for r in records:
+            if genres.get(r.get('genre')) is None or users.get(r.get('user')) is None:
+                self.skipped += 1
+                if r.get('id') is not None:
+                    # Comments on a skipped post are skipped too.
+                    mapping.append((r['id'], None))
+                continue
+            timestamp = parse_timestamp(r.get('timestamp')) or datetime.utcnow()
+            votes = r.get('votes') or 0
+            rows.append((id, genres[r['genre']], users[r['user']], r.get('name'), r.get('content'), votes,
+                         timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'), hot_score(votes, timestamp), 0))
+            if r.get('id') is not None:
+                mapping.append((r['id'], id))
+            id += 1
+        self.executemany('post', 'INSERT INTO posts (id, genre_id, user_id, name, content, votes, timestamp, '
+                         'hot, comment_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.executemany('INSERT OR REPLACE INTO import_post_ids (old, new) VALUES (?, ?)', mapping)
+
+    def insert_comments(self, records):
+        users = self.resolve(self.user_ids, 'users', [r.get('user') for r in records])
+        olds = list(set(r.get('post') for r in records))
+        posts = {}
+        for i in range(0, len(olds), 500):
+            chunk = olds[i:i + 500]
+            posts.update(self.connection.execute('SELECT old, new FROM import_post_ids WHERE old IN (%s)' %
+                                                 ','.join('?' * len(chunk)), chunk).fetchall())
+        existing = [old for old in olds if old not in posts and isinstance(old, int)]
+        for i in range(0, len(existing), 500):
+            chunk = existing[i:i + 500]
+            posts.update((id, id) for (id,) in self.connection.execute(
+                'SELECT id FROM posts WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        rows = []
+        for r in records:
+            if users.get(r.get('user')) is None or posts.get(r.get('post')) is None:
+                self.skipped += 1
+                continue
+            rows.append((r.get('content'), r['user'], posts[r['post']], users[r['user']]))
+        self.executemany('comment', 'INSERT INTO comments (content, whoPosted, posts_id, user_id) '
+                         'VALUES (?, ?, ?, ?)', rows)
+
+
+def open_stream(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+@manager.option('-f', '--file', dest='path', default='-', help='JSONL file to read (.gz ok), - for stdin')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=None)
+def import_jsonl(path, batch_size=None):
+    """Bulk-load genre, user, post and comment records from JSONL."""
+    db.create_all()
+    importer = JsonlImporter(batch_size or current_app.config['IMPORT_BATCH_SIZE'], current_app.config['IMPORT_TRANSACTION_ROWS'])
+    stream = open_stream(path, 'r')
+    try:
+        for line in stream:
+            if line.strip():
+                importer.add(json.loads(line))
+        importer.finish()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    repair_counters()
+    with db.engine.begin() as connection:
+        bump_versions(['global'], connection)
+    print('Imported %s; skipped %d' % (', '.join('%d %ss' % (importer.counts[kind], kind)
+                                                 for kind in JsonlImporter.ORDER), importer.skipped))
+
+
+EXPORT_QUERIES = [
+    ('genre', 'SELECT name FROM genres ORDER BY id', ('name',)),
+    ('user', 'SELECT name, password, homeTown, bio, is_musician FROM users ORDER BY id',
+     ('name', 'password', 'homeTown', 'bio', 'is_musician')),
+    ('post', 'SELECT posts.id, genres.name, users.name, posts.name, posts.content, posts.votes, posts.timestamp '
+             'FROM {posts} AS posts JOIN genres ON genres.id = posts.genre_id JOIN users ON users.id = posts.user_id '
+             'ORDER BY posts.id',
+     ('id', 'genre', 'user', 'name', 'content', 'votes', 'timestamp')),
+    ('comment', 'SELECT comments.posts_id, users.name, comments.content FROM {comments} AS comments '
+                'JOIN users ON users.id = comments.user_id ORDER BY comments.id',
+     ('post', 'user', 'content')),
+]
+EXPORT_COLUMNS = {'posts': 'id, genre_id, user_id, name, content, votes, timestamp',
+                  'comments': 'id, posts_id, user_id, content'}
+
+
+@manager.option('-f', '--file', dest='path', default='-', help='JSONL file to write (.gz ok), - for stdout')
+def export_jsonl(path):
+    """Stream every genre, user, post and comment out as JSONL, in import order."""
+    stream = open_stream(path, 'w')
+    try:
+        with archive_attached() as (connection, archived):
+            sources = {'posts': 'main.posts', 'comments': 'main.comments'}
+            if archived:
+                # Archived rows export with the rest.
+                sources = dict((table, '(SELECT %s FROM archive.%s UNION ALL SELECT %s FROM main.%s)' % (
+                    columns, table, columns, table)) for table, columns in EXPORT_COLUMNS.items())
+            raw = connection.connection.connection
+            for kind, sql, fields in EXPORT_QUERIES:
+                # The sqlite3 cursor steps through rows lazily, so memory
+                # stays flat regardless of table size.
+                for row in raw.execute(sql.format(**sources)):
+                    record = dict(zip(fields, row))
+                    record['type'] = kind
+                    if 'is_musician' in record:
+                        record['is_musician'] = bool(record['is_musician'])
+                    stream.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+
 if __name__ == '__main__':
-    app.run()
+    manager.run(default_command='runserver')
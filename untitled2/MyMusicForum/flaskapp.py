@@ -1,5 +1,5 @@
 import os
-from flask import Flask, render_template, session, redirect, url_for, flash
+from flask import Flask, Blueprint, render_template, session, redirect, url_for, flash
 from flask_script import Manager
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
@@ -7,19 +7,44 @@ from flask_wtf import Form
 from wtforms import StringField, SubmitField, SelectField, PasswordField, IntegerField
 from wtforms.validators import Required, DataRequired
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'hard to guess string'
-app.config['SQLALCHEMY_DATABASE_URI'] =\
-    'sqlite:///' + os.path.join(basedir, 'data.sqlite')
-app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 
-manager = Manager(app)
-bootstrap = Bootstrap(app)
-moment = Moment(app)
-db = SQLAlchemy(app)
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'hard to guess string'
+    app.config['SQLALCHEMY_DATABASE_URI'] =\
+        'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+    app.config['JINJA_CACHE_DIR'] = os.path.join(basedir, 'jinja-cache')
+    app.config.update(config or {})
+
+    bootstrap.init_app(app)
+    moment.init_app(app)
+    db.init_app(app)
+    app.register_blueprint(views)
+    if app.config['JINJA_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+    return app
+
+
+class Views(Blueprint):
+    # Endpoints keep their bare names (url_for('ShowPost')) instead of
+    # taking the blueprint prefix.
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        endpoint = endpoint or view_func.__name__
+        self.record(lambda state: state.app.add_url_rule(rule, endpoint, view_func, **options))
+
+
+manager = Manager(create_app)
+bootstrap = Bootstrap()
+moment = Moment()
+db = SQLAlchemy()
+views = Views('views', __name__)
 
 class Genre(db.Model):
 
@@ -176,16 +201,16 @@ class GenreForm(Form):
     submit = SubmitField('Submit')
 
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@views.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
 
-@app.route('/New Post', methods=['GET', 'POST'])
+@views.route('/New Post', methods=['GET', 'POST'])
 def NewPost():
     form = PostForm()
     form.genre.choices = [(a.id, a.name) for a in Genre.query.order_by(Genre.name)]
@@ -198,7 +223,7 @@ def NewPost():
         return redirect(url_for('NewPost'))
     return render_template('New Post.html', form=form)
 
-@app.route('/Show Post/<id>', methods=['GET', 'POST'])
+@views.route('/Show Post/<id>', methods=['GET', 'POST'])
 def ShowPost(id):
     form = CommentForm()
     Posts = Post.query.filter_by(id=id).first()
@@ -214,7 +239,7 @@ def ShowPost(id):
 
 
 
-@app.route('/New Genre', methods=['GET', 'POST'])
+@views.route('/New Genre', methods=['GET', 'POST'])
 def NewGenre():
     form = GenreForm()
     if form.validate_on_submit():
@@ -226,7 +251,7 @@ def NewGenre():
         return redirect(url_for('NewGenre'))
     return render_template('New Genre.html', form=form)
 
-@app.route('/New Artist', methods=['GET', 'POST'])
+@views.route('/New Artist', methods=['GET', 'POST'])
 def NewArtist():
     form = ArtistSignUpForm()
     if form.validate_on_submit():
@@ -240,7 +265,7 @@ def NewArtist():
         return redirect(url_for('UserPage'))
     return render_template('New Artist.html', form=form)
 
-@app.route('/Login', methods=['GET', 'POST'])
+@views.route('/Login', methods=['GET', 'POST'])
 def Login():
     form = LoginForm()
     if form.validate_on_submit():
@@ -252,12 +277,12 @@ def Login():
         flash('Wrong Login Details!')
     return render_template('Login.html', form=form)
 
-@app.route('/Logout', methods=['GET', 'POST'])
+@views.route('/Logout', methods=['GET', 'POST'])
 def Logout():
     session['logged_in'] = False
     return render_template('index.html')
 
-@app.route('/New User', methods=['GET', 'POST'])
+@views.route('/New User', methods=['GET', 'POST'])
 def NewUser():
     form = ArtistSignUpForm()
     if form.validate_on_submit():
@@ -271,29 +296,29 @@ def NewUser():
         return redirect(url_for('UserPage'))
     return render_template('New User.html', form=form)
 
-@app.route('/User Page', methods=['GET', 'POST'])
+@views.route('/User Page', methods=['GET', 'POST'])
 def UserPage():
     name = session['user']
     allDetails = User.query.filter_by(name=name).first()
     userPosts = Post.query.filter_by(user_id=allDetails.id)
     return render_template('User Page.html', allDetails=allDetails, userPosts = userPosts)
 
-@app.route('/All Boards', methods=['GET', 'POST'])
+@views.route('/All Boards', methods=['GET', 'POST'])
 def AllBoards():
     allBoards = Genre.query.all()
     return render_template('All Boards.html', allBoards=allBoards)
 
-@app.route('/Board/<id>', methods=['GET', 'POST'])
+@views.route('/Board/<id>', methods=['GET', 'POST'])
 def Board(id):
     Posts = Post.query.filter_by(genre_id=id)
     thisBoard = Genre.query.filter_by(id=id).first()
     return render_template('Board.html', Posts=Posts, thisBoard=thisBoard)
 
-@app.route('/UserOrArtist', methods=['GET', 'POST'])
+@views.route('/UserOrArtist', methods=['GET', 'POST'])
 def UserOrArtist():
     return render_template('UserOrArtist.html')
 
-@app.route('/Artist List', methods=['GET'])
+@views.route('/Artist List', methods=['GET'])
 def ArtistList():
     name = session['user']
     userDetails = User.query.filter_by(name=name).first()
@@ -301,40 +326,41 @@ def ArtistList():
     localArtists = User.query.filter_by(homeTown = userDetails.homeTown, is_musician=True)
     return render_template('Artist List.html',  allArtists=allArtists, localArtists = localArtists)
 
-@app.route('/Artist Details/<name>', methods=['GET', 'POST'])
+@views.route('/Artist Details/<name>', methods=['GET', 'POST'])
 def ArtistDetails(name):
     allArtists = User.query.filter_by(name = name).first()
     artistPosts = Post.query.filter_by(user_id=allArtists.id)
     return render_template('Artist Details.html',  allArtists=allArtists, artistPosts=artistPosts)
 
 
-@app.route('/', methods=['GET', 'POST'])
+@views.route('/', methods=['GET', 'POST'])
 def index():
     return render_template('index.html')
 
 
-if __name__ == '__main__':
-    f = open('docs.html', 'w')
-    top = """<html>
+DOCS_TOP = """<html>
 <head></head>
 <body>"""
-    bottom = """</body>
+DOCS_BOTTOM = """</body>
 </html>"""
 
-    f.truncate()
-    f.write(top)
 
-    f.write(Genre.__doc__)
-    f.write(User.__doc__)
-    f.write(Post.__doc__)
-    f.write(Comment.__doc__)
+@manager.command
+def build_docs():
+    """Regenerate docs.html from the model docstrings if they have changed."""
+    html = DOCS_TOP + Genre.__doc__ + User.__doc__ + Post.__doc__ + Comment.__doc__ + DOCS_BOTTOM
+    path = os.path.join(basedir, 'docs.html')
+    try:
+        with open(path) as f:
+            if f.read() == html:
+                print('docs.html is up to date')
+                return
+    except IOError:
+        pass
+    with open(path, 'w') as f:
+        f.write(html)
+    print('Wrote docs.html')
 
-    f.write(bottom)
-    f.close()
 
-    print(Genre.__doc__)
-    print(User.__doc__)
-    print(Post.__doc__)
-    print(Comment.__doc__)
-
-    app.run()
\ No newline at end of file
+if __name__ == '__main__':
+    manager.run(default_command='runserver')
@@ -0,0 +1,8 @@
+"""WSGI entry point, e.g. gunicorn wsgi:application.
+
+Serves the default tenant; use create_tenants_app() instead to serve every
+tenant from one process.
+"""
+from flaskapp import create_app
+
+application = create_app()